@@ -0,0 +1,147 @@
+
+import json
+
+import numpy as np
+
+
+class Connectivity:
+    """
+    Stack of symmetric connectivity matrices stored in condensed form (upper triangle, row-major as in
+    np.triu_indices), with or without the diagonal.
+
+    It is the common container for the outputs of fc.fc, fc.dynamic_fc, fc.plv, fc.coh and fc.aec. Square
+    matrices are only built on request (square()), and edges are accessed in O(1) through their condensed index.
+
+    :param data: Condensed values with shape [... x edges]
+    :param n_nodes: Number of nodes
+    :param diagonal: Whether the condensed data include the diagonal
+    :param labels: Node labels
+    :param dtype: Storage dtype (defaults to the data dtype)
+    :param method: Name of the connectivity measure
+    :param fill: Value of the diagonal when it is not stored
+    """
+
+    def __init__(self, data, n_nodes, diagonal=True, labels=None, dtype=None, method=None, fill=0):
+
+        self.data = np.asarray(data, dtype=dtype)
+        self.n_nodes = int(n_nodes)
+        self.diagonal = bool(diagonal)
+        self.labels = None if labels is None else list(labels)
+        self.method = method
+        self.fill = fill
+
+        if self.data.shape[-1] != self.n_edges:
+            raise ValueError("Expected %i edges for %i nodes, got %i." % (self.n_edges, self.n_nodes, self.data.shape[-1]))
+
+        if self.labels is not None and len(self.labels) != self.n_nodes:
+            raise ValueError("Expected %i labels, got %i." % (self.n_nodes, len(self.labels)))
+
+    @classmethod
+    def from_square(cls, matrix, diagonal=True, labels=None, dtype=None, method=None):
+        """ Condenses square matrices with shape [... x nodes x nodes] (only the upper triangle is read)."""
+
+        matrix = np.asarray(matrix)
+        n_nodes = matrix.shape[-1]
+        triu = np.triu_indices(n_nodes, k=0 if diagonal else 1)
+
+        return cls(matrix[..., triu[0], triu[1]], n_nodes, diagonal=diagonal, labels=labels, dtype=dtype,
+                   method=method)
+
+    @property
+    def n_edges(self):
+        return self.n_nodes * (self.n_nodes + 1) // 2 if self.diagonal else self.n_nodes * (self.n_nodes - 1) // 2
+
+    @property
+    def shape(self):
+        """ Shape of the stack (without the edges dimension)."""
+        return self.data.shape[:-1]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def __len__(self):
+        if not self.shape:
+            raise TypeError("len() of a single connectivity matrix (not a stack).")
+
+        return self.shape[0]
+
+    def __repr__(self):
+        return "<Connectivity %s| %i nodes, %i edges%s, %s>" % (
+            "" if self.method is None else self.method + " ", self.n_nodes, self.n_edges,
+            " (+diagonal)" if self.diagonal else "", self.data.dtype)
+
+    def index(self, i, j):
+        """ Condensed index of the edge (i, j); order of the nodes does not matter."""
+
+        i, j = min(i, j), max(i, j)
+        if self.diagonal:
+            return i * self.n_nodes - i * (i - 1) // 2 + (j - i)
+        elif i == j:
+            raise IndexError("The diagonal is not stored.")
+        else:
+            return i * self.n_nodes - i * (i + 1) // 2 + (j - i - 1)
+
+    def edge(self, i, j):
+        """ Values of the edge (i, j) along the stack. Nodes can be given as indices or labels."""
+
+        i = self.labels.index(i) if isinstance(i, str) else i
+        j = self.labels.index(j) if isinstance(j, str) else j
+
+        if i == j and not self.diagonal:
+            return np.full(self.shape, self.fill, dtype=self.data.dtype)
+
+        return self.data[..., self.index(i, j)]
+
+    def __getitem__(self, item):
+        """ Sub-stack (e.g., one window or repetition) as a Connectivity object."""
+
+        if not self.shape:
+            raise TypeError("A single connectivity matrix (not a stack) cannot be indexed; use edge() or square().")
+
+        if not isinstance(item, tuple):
+            item = (item,)
+
+        return Connectivity(self.data[item + (Ellipsis, slice(None))], self.n_nodes, diagonal=self.diagonal,
+                            labels=self.labels, method=self.method, fill=self.fill)
+
+    def square(self, item=None):
+        """
+        Expands the condensed data into symmetric [... x nodes x nodes] matrices.
+
+        :param item: Index in the stack to expand only part of it (e.g., a single window)
+        """
+
+        data = self.data if item is None else self.data[item]
+
+        matrix = np.full(data.shape[:-1] + (self.n_nodes, self.n_nodes), self.fill, dtype=data.dtype)
+        triu = np.triu_indices(self.n_nodes, k=0 if self.diagonal else 1)
+        matrix[..., triu[0], triu[1]] = data
+        matrix[..., triu[1], triu[0]] = data
+
+        return matrix
+
+    def astype(self, dtype):
+        return Connectivity(self.data.astype(dtype), self.n_nodes, diagonal=self.diagonal, labels=self.labels,
+                            method=self.method, fill=self.fill)
+
+    def save(self, filename):
+        """ Saves the condensed data as filename.npy and the metadata as filename.json."""
+
+        filename = filename[:-4] if filename.endswith(".npy") else filename
+
+        np.save(filename + ".npy", self.data)
+        with open(filename + ".json", "w") as file:
+            json.dump(dict(n_nodes=self.n_nodes, diagonal=self.diagonal, labels=self.labels, method=self.method,
+                           fill=self.fill), file)
+
+    @classmethod
+    def load(cls, filename, mmap_mode="r"):
+        """ Loads a saved Connectivity object; by default the data are memory-mapped (read only)."""
+
+        filename = filename[:-4] if filename.endswith(".npy") else filename
+
+        with open(filename + ".json") as file:
+            meta = json.load(file)
+
+        return cls(np.load(filename + ".npy", mmap_mode=mmap_mode), **meta)
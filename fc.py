@@ -1,8 +1,12 @@
 
 import time
 import math
+import itertools
 
-from collections import Counter
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import multiprocessing
+from multiprocessing import shared_memory
 from mne import filter, time_frequency
 # import mne_connectivity
 
@@ -17,48 +21,51 @@ import plotly.express as px
 import sys
 sys.path.append("E:\\LCCN_Local\\PycharmProjects\\")
 from pyToolbox.signals import epochingTool
-from pyToolbox import mnetools
+from pyToolbox import mnetools, kernels
+from pyToolbox.connectivity import Connectivity
+from pyToolbox.fft import welch_csd
+
+
+# Memory budget (bytes) for the temporaries of block-wise estimators.
+MEMLIMIT = 256 * 1024 ** 2
+
+# Canonical frequency bands (Hz).
+BANDS = {"Delta": (2, 4), "Theta": (4, 8), "Alpha": (8, 12), "Beta": (12, 30), "Gamma": (30, 45)}
+
+# Process-wide cache of filtered and analytic signals (opt-in through set_cache).
+_cache = OrderedDict()
+_cache_info = dict(enabled=False, maxbytes=1024 ** 3, nbytes=0, hits=0, misses=0)
 
 
 ## Static functional connetivity
 def fc(signals, samplingFreq=None, lowcut=8, highcut=12, measure="PLV", ef=None, regionLabels=None,
-       folder=None, plot=None, verbose=False, auto_open=False):
+       folder=None, plot=None, verbose=False, auto_open=False, single=None, container=False, engine="numpy"):
     """
+    Static functional connectivity (PLV, PLI, wPLI, dwPLI, AEC, CORR) between signals.
 
+    :param single: Work in float32/complex64 from the filtered signals on, Hilbert transform included (None:
+     mnetools.set_precision default); PLI keeps double precision phases
+    :param container: Return a Connectivity object (condensed, with the region labels) instead of the matrix
+    :param engine: "numpy" or "numba" (compiled pair loops for PLV and the PLI family; see kernels)
     """
     tic = time.time()
+    single = mnetools.get_single(single)
 
     n_rois = len(signals)
     fc_matrix = np.ndarray((n_rois, n_rois))
 
     if "CORR" in measure:
 
-        stdSignals = (signals - np.average(signals, axis=0)) / np.std(signals, axis=0)
-
-        # normalSignals = np.ndarray((len(signals), len(signals[0])))
-        # for channel in range(len(signals)):
-        #     mean = np.mean(signals[channel, :])
-        #     std = np.std(signals[channel, :])
-        #     normalSignals[channel] = (signals[channel, :] - mean) / std
-        print("Calculating PLV", end="") if verbose else None
-        for r1, roi1 in enumerate(range(n_rois)):
-            print(" . . . %0.2f %%" % ((r1+1)/n_rois), end="\r") if verbose else None
-            for roi2 in range(n_rois):
-                fc_matrix[roi1][roi2] = sum(stdSignals[roi1] * stdSignals[roi2]) / len(stdSignals[0])
+        print("Calculating CORR", end="") if verbose else None
+        fc_matrix = fc_corr(signals, single=single)
 
-    elif measure in ["PLV", "AEC", "PLI"]:
+    elif measure in ["PLV", "AEC", "PLI", "wPLI", "dwPLI"]:
 
         if not ef:
-            filterSignals = filter.filter_data(signals, samplingFreq, lowcut, highcut, verbose=verbose)
-            efSignals = epochingTool(filterSignals, 4, samplingFreq, "signals", verbose=verbose)
-
-            # Obtain Analytical signal
-            efPhase, efEnvelope = [], []
-            for i in range(len(efSignals)):
-                analyticalSignal = signal.hilbert(efSignals[i])
-                # Get instantaneous phase and amplitude envelope by channel
-                efPhase.append(np.angle(analyticalSignal))
-                efEnvelope.append(np.abs(analyticalSignal))
+            # PLI keeps double precision phases: a single sign flip of sin(phase difference) moves it by
+            # 2 / (samples x epochs).
+            efPhase, efEnvelope = analytic_epochs(signals, samplingFreq, lowcut, highcut, verbose=verbose,
+                                                  single=single and measure != "PLI")
 
             # Check point
             # from toolbox import timeseriesPlot, plotConversions
@@ -70,40 +77,21 @@ def fc(signals, samplingFreq=None, lowcut=8, highcut=12, measure="PLV", ef=None,
         elif "efEnvelope" in ef:
             efEnvelope = np.array(signals)[np.newaxis, :, :]
 
+        # Transforms the provided phases into single precision, if requested (AEC casts the envelopes itself).
+        elif single and measure in ["PLV", "wPLI", "dwPLI"]:
+            efPhase = np.asarray(efPhase, dtype=np.float32)
+
         if "PLV" in measure:
             print("Calculating PLV", end="") if verbose else None
-            for r1, roi1 in enumerate(range(n_rois)):
-                print(" . . . %0.2f %%" % ((r1 + 1) / n_rois), end="\r") if verbose else None
-                for roi2 in range(n_rois):
-                    plv_values = list()
-                    for epoch in range(len(efPhase)):
-                        phaseDifference = efPhase[epoch][roi1] - efPhase[epoch][roi2]
-                        value = abs(np.average(np.exp(1j * phaseDifference)))
-                        plv_values.append(value)
-                    fc_matrix[roi1, roi2] = np.average(plv_values)
+            fc_matrix = fc_plv(efPhase, engine=engine)
 
         elif "AEC" in measure:
             print("Calculating AEC", end="") if verbose else None
-            for r1, roi1 in enumerate(range(n_rois)):
-                print(" . . . %0.2f %%" % ((r1 + 1) / n_rois), end="\r") if verbose else None
-                for roi2 in range(n_rois):
-                    values_aec = list()  # AEC per epoch and channel x channel
-                    for epoch in range(len(efEnvelope)):  # CORR between channels by epoch
-                        r = np.corrcoef(efEnvelope[epoch][roi1], efEnvelope[epoch][roi2])
-                        values_aec.append(r[0, 1])
-                    fc_matrix[roi1, roi2] = np.average(values_aec)
+            fc_matrix = fc_aec(efEnvelope, single=single)
 
         elif "PLI" in measure:
-            print("Calculating PLI", end="") if verbose else None
-            for r1, roi1 in enumerate(range(n_rois)):
-                print(" . . . %0.2f %%" % ((r1 + 1) / n_rois), end="\r") if verbose else None
-                for roi2 in range(n_rois):
-                    pli_values = list()
-                    for epoch in range(len(efPhase)):
-                        phaseDifference = efPhase[epoch][roi1] - efPhase[epoch][roi2]
-                        value = np.abs(np.average(np.sign(np.sin(phaseDifference))))
-                        pli_values.append(value)
-                    fc_matrix[roi1, roi2] = np.average(pli_values)
+            print("Calculating %s" % measure, end="") if verbose else None
+            fc_matrix = fc_pli(efPhase, measure=measure, verbose=verbose, engine=engine)
 
     else:
         print("Unkown measure. Exit")
@@ -124,12 +112,376 @@ def fc(signals, samplingFreq=None, lowcut=8, highcut=12, measure="PLV", ef=None,
 
     print("  -  %0.3f seconds.\n" % (time.time() - tic,)) if verbose else None
 
+    if container:
+        return Connectivity.from_square(fc_matrix, labels=regionLabels, method=measure)
+
     return fc_matrix
 
 
+def fc_multi(signals, samplingFreq, bands, measures=("PLV", "PLI", "AEC", "CORR"), single=None, verbose=False):
+    """
+    Several FC measures from a single preprocessing pass per band.
+
+    Signals are filtered, epoched and Hilbert transformed once per band, and every requested measure is
+    computed from the shared phase and envelope arrays. CORR does not depend on the band and it is computed
+    once on the raw signals.
+
+    :param signals: Signals in shape [ROIS x time]
+    :param samplingFreq: sampling frequency (Hz)
+    :param bands: dict {name: (lowcut, highcut)} or list of (lowcut, highcut) tuples
+    :param measures: any of "PLV", "PLI", "wPLI", "dwPLI", "AEC", "CORR"
+    :param single: Work in float32/complex64 from the filtered signals on, Hilbert transform included (None:
+     mnetools.set_precision default); PLI keeps double precision phases
+    :return: dict {band: {measure: fc_matrix}}
+    """
+    tic = time.time()
+    single = mnetools.get_single(single)
+
+    if not isinstance(bands, dict):
+        bands = {tuple(band): band for band in bands}
+
+    unknown = [measure for measure in measures if measure not in ["PLV", "PLI", "wPLI", "dwPLI", "AEC", "CORR"]]
+    if unknown:
+        raise ValueError("Unknown measures: %s" % unknown)
+
+    if "CORR" in measures:
+        corr_matrix = fc_corr(signals, single=single)
+
+    result = dict()
+    for name, (lowcut, highcut) in bands.items():
+        print("Calculating %s for %s band" % (measures, name), end="") if verbose else None
+
+        efPhase, efEnvelope = analytic_epochs(signals, samplingFreq, lowcut, highcut, verbose=verbose,
+                                              single=single)
+
+        # PLI keeps double precision phases (see fc)
+        dPhase = efPhase
+        if single and "PLI" in measures:
+            dPhase = analytic_epochs(signals, samplingFreq, lowcut, highcut, verbose=verbose)[0]
+
+        result[name] = dict()
+        for measure in measures:
+            if measure == "PLV":
+                result[name][measure] = fc_plv(efPhase)
+            elif measure == "PLI":
+                result[name][measure] = fc_pli(dPhase, measure=measure)
+            elif "PLI" in measure:
+                result[name][measure] = fc_pli(efPhase, measure=measure)
+            elif measure == "AEC":
+                result[name][measure] = fc_aec(efEnvelope, single=single)
+            elif measure == "CORR":
+                result[name][measure] = corr_matrix
+
+    print("  -  %0.3f seconds.\n" % (time.time() - tic,)) if verbose else None
+
+    return result
+
+
+def analytic_epochs(signals, samplingFreq, lowcut, highcut, epoch=4, verbose=False, single=False):
+    """
+    Band-pass filters the signals, cuts them into epochs and gets their analytical signal.
+
+    :param signals: Signals in shape [ROIS x time]
+    :param samplingFreq: sampling frequency (Hz)
+    :param epoch: Epoch length (seconds); epochs do not overlap
+    :param single: Epoch and Hilbert transform the filtered signals in float32/complex64
+    :return: efPhase, efEnvelope with shape [epochs x rois x time]
+    """
+
+    def compute():
+        filterSignals = band_filter(signals, samplingFreq, lowcut, highcut, verbose=verbose)
+        efSignals = np.asarray(epochingTool(filterSignals, epoch, epoch, samplingFreq, "signals", verbose=verbose),
+                               dtype=np.float32 if single else None)
+
+        # Obtain Analytical signal; get instantaneous phase and amplitude envelope by channel
+        analyticalSignal = signal.hilbert(efSignals, axis=-1)
+
+        return np.angle(analyticalSignal), np.abs(analyticalSignal)
+
+    return cached(("analytic_epochs", signals, samplingFreq, lowcut, highcut, epoch, bool(single)), compute)
+
+
+def band_filter(data, samplingFreq, lowcut, highcut, verbose=False):
+    """ Band-pass filters the signals with mne.filter.filter_data (default FIR design)."""
+
+    return cached(("filter_data", data, samplingFreq, lowcut, highcut),
+                  lambda: filter.filter_data(data, samplingFreq, lowcut, highcut, verbose=verbose))
+
+
+def analytic_padded(data, samplingFreq, lowcut, highcut, filtered=False, padding=1000, verbose=False):
+    """
+    Instantaneous phase of the (band-pass filtered) signals. Signals are zero padded before the Hilbert
+    transform as it has distortions at edges.
+    """
+
+    def compute():
+        filterSignals = data if filtered else band_filter(data, samplingFreq, lowcut, highcut, verbose=verbose)
+
+        pad = np.zeros((len(data), padding))
+        analyticalSignal_padded = signal.hilbert(np.concatenate([pad, filterSignals, pad], axis=1))
+
+        # Get instantaneous phase by channel
+        return np.angle(analyticalSignal_padded)[:, padding:-padding]
+
+    band = (None, None) if filtered else (lowcut, highcut)
+    return cached(("analytic_padded", data, samplingFreq) + band + (padding,), compute)
+
+
+## Analytic-signal cache
+def set_cache(enabled=True, maxbytes=1024 ** 3):
+    """
+    Enables (or disables) the process-wide cache of filtered and analytic signals used by fc, fc_multi,
+    dynamic_fc, kuramoto_order and kuramoto_polar, and of the FIR designs of bandpass_fir. Entries are keyed by (data fingerprint, sampling
+    frequency, band, filter design) and evicted in least-recently-used order to stay below maxbytes.
+    Cached arrays are returned read-only.
+    """
+
+    _cache_info["enabled"] = enabled
+    _cache_info["maxbytes"] = maxbytes
+
+    if not enabled:
+        clear_cache()
+    else:
+        _evict()
+
+
+def clear_cache():
+    """ Empties the analytic-signal cache and resets its counters."""
+
+    _cache.clear()
+    _cache_info.update(nbytes=0, hits=0, misses=0)
+
+
+def cache_info():
+    """ Returns the analytic-signal cache counters: hits, misses, entries, nbytes and maxbytes."""
+
+    return dict(_cache_info, entries=len(_cache))
+
+
+def cached(key, compute):
+    """
+    Looks up key in the analytic-signal cache, computing and storing the result on a miss. Any array in the
+    key is replaced by its fingerprint. compute() must return an array or a tuple of arrays.
+    """
+
+    if not _cache_info["enabled"]:
+        return compute()
+
+    key = tuple(mnetools.fingerprint(item) if isinstance(item, (np.ndarray, list)) else item for item in key)
+
+    if key in _cache:
+        _cache_info["hits"] += 1
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    _cache_info["misses"] += 1
+    value = compute()
+
+    arrays = value if isinstance(value, tuple) else (value,)
+    for array in arrays:
+        array.setflags(write=False)
+
+    nbytes = sum(array.nbytes for array in arrays)
+    if nbytes <= _cache_info["maxbytes"]:
+        _cache[key] = value
+        _cache_info["nbytes"] += nbytes
+        _evict()
+
+    return value
+
+
+def _evict():
+    while _cache_info["nbytes"] > _cache_info["maxbytes"]:
+        key, value = _cache.popitem(last=False)
+        _cache_info["nbytes"] -= sum(array.nbytes for array in (value if isinstance(value, tuple) else (value,)))
+
+
+def filterbank(signals, samplingFreq, bands=None, numtaps=None, hilbert=True):
+    """
+    Filters the signals into several frequency bands in one pass.
+
+    Each chunk of data is Fourier transformed once and multiplied by the (two-pass) response of a
+    Hamming-windowed FIR filter per band. With hilbert=True the analytic signal is obtained in the same step.
+
+    :param signals: Signals in shape [ROIS x time]
+    :param samplingFreq: sampling frequency (Hz)
+    :param bands: dict {name: (lowcut, highcut)}; defaults to the canonical BANDS
+    :param numtaps: FIR length; defaults to three cycles of the lowest frequency
+    :param hilbert: Return the analytic signal (complex)
+    :return: [bands x ROIS x time] array, list of band names
+    """
+
+    if bands is None:
+        bands = BANDS
+
+    if numtaps is None:
+        numtaps = int(3 * samplingFreq / min(lowcut for lowcut, highcut in bands.values()))
+
+    nums = [bandpass_fir(numtaps, band, samplingFreq) for band in bands.values()]
+
+    return mnetools.signal_filterbank(signals, nums=nums, hilbert=hilbert), list(bands.keys())
+
+
+def bandpass_fir(numtaps, band, samplingFreq):
+    """
+    Hamming-windowed band-pass FIR filter, as used by plv() and aec().
+
+    Designs are memoized by (numtaps, band, samplingFreq) in the analytic-signal cache (see cached()) and returned
+    read-only.
+    """
+
+    key = ("bandpass_fir", int(numtaps), tuple(float(freq) for freq in band), float(samplingFreq))
+
+    return cached(key, lambda: signal.firwin(key[1], key[2], fs=key[3], window='hamming', pass_zero='bandpass'))
+
+
+def fc_plv(efPhase, engine="numpy"):
+    """
+    Phase Locking Value for all pairs of ROIs at once.
+
+    Each epoch phase is turned into unit phasors once and the whole complex PLV matrix is obtained from a
+    single batched matrix product across epochs. Only the upper triangle is kept and mirrored.
+
+    :param efPhase: Phase component of Hilbert transform with shape [epochs x rois x time]
+    :param engine: "numpy" or "numba" (compiled pair loop, without the [epochs x rois x rois] temporary)
+    :return: PLV matrix (rois, rois) averaged across epochs
+    """
+
+    efPhase = np.asarray(efPhase)
+    n_rois, n_samples = efPhase.shape[-2], efPhase.shape[-1]
+
+    if kernels.resolve_engine(engine) == "numba":
+        efPhase = efPhase.reshape((-1, n_rois, n_samples))
+        return kernels.plv_pairs(np.sin(efPhase), np.cos(efPhase))
+
+    # Unit phasors per epoch and ROI
+    phasors = np.exp(1j * efPhase)
+
+    # Complex PLV of every pair and epoch: [epochs x rois x rois]
+    cplv = np.matmul(phasors, np.swapaxes(phasors, -1, -2).conj()) / n_samples
+
+    # Average modulus across epochs in the upper triangle, then mirror
+    triu = np.triu_indices(n_rois)
+    fc_matrix = np.zeros((n_rois, n_rois))
+    fc_matrix[triu] = np.average(np.abs(cplv[:, triu[0], triu[1]]), axis=0)
+    fc_matrix.T[triu] = fc_matrix[triu]
+
+    return fc_matrix
+
+
+def fc_pli(efPhase, measure="PLI", mem_limit=MEMLIMIT, verbose=False, engine="numpy"):
+    """
+    Phase Lag Index family (PLI, weighted PLI and debiased weighted PLI) for all pairs of ROIs.
+
+    Each ROI is compared against a block of the following ROIs, vectorized over time and epochs. The block
+    size is chosen so that the temporaries stay within mem_limit bytes. The sine of the phase difference is
+    obtained as sin(a)cos(b) - cos(a)sin(b) from sines and cosines computed once.
+
+    REFERENCE || Stam et al. (2007) Phase lag index: assessment of functional connectivity from multi channel EEG
+    and MEG with diminished bias from common sources.
+    Vinck et al. (2011) An improved index of phase-synchronization for electrophysiological data in the
+    presence of volume-conduction, noise and sample-size bias.
+
+    :param efPhase: Phase component of Hilbert transform with shape [epochs x rois x time]
+    :param measure: "PLI", "wPLI" or "dwPLI"
+    :param mem_limit: Memory budget (bytes) for the block temporaries
+    :param engine: "numpy" or "numba" (compiled pair loop, without block temporaries)
+    :return: matrix (rois, rois) averaged across epochs
+    """
+
+    if measure not in ["PLI", "wPLI", "dwPLI"]:
+        raise ValueError("Unknown PLI measure: %s" % measure)
+
+    efPhase = np.asarray(efPhase)
+    n_epochs, n_rois, n_samples = efPhase.shape
+
+    sinPhase, cosPhase = np.sin(efPhase), np.cos(efPhase)
+
+    if kernels.resolve_engine(engine) == "numba":
+        return kernels.pli_pairs(sinPhase, cosPhase, ["PLI", "wPLI", "dwPLI"].index(measure))
+
+    # Three float64 temporaries of shape [epochs x block x time]
+    block = int(max(1, mem_limit // (3 * 8 * n_epochs * n_samples)))
+
+    fc_matrix = np.zeros((n_rois, n_rois))
+    for roi1 in range(n_rois):
+        print(" . . . %0.2f %%" % ((roi1 + 1) / n_rois), end="\r") if verbose else None
+        for b0 in range(roi1 + 1, n_rois, block):
+            b1 = min(b0 + block, n_rois)
+
+            # sin(phase1 - phase2) for the whole block: [epochs x block x time]
+            sinDifference = sinPhase[:, [roi1]] * cosPhase[:, b0:b1] - cosPhase[:, [roi1]] * sinPhase[:, b0:b1]
+
+            if measure == "PLI":
+                values = np.abs(np.average(np.sign(sinDifference), axis=-1))
+
+            else:
+                num = np.sum(sinDifference, axis=-1)
+                den = np.sum(np.abs(sinDifference), axis=-1)
+
+                if measure == "wPLI":
+                    values = np.abs(num) / np.maximum(den, np.finfo(float).tiny)
+
+                else:
+                    sqr = np.sum(sinDifference ** 2, axis=-1)
+                    values = (num ** 2 - sqr) / np.maximum(den ** 2 - sqr, np.finfo(float).tiny)
+
+            fc_matrix[roi1, b0:b1] = np.average(values, axis=0)
+
+    fc_matrix.T[np.triu_indices(n_rois, 1)] = fc_matrix[np.triu_indices(n_rois, 1)]
+
+    return fc_matrix
+
+
+def fc_aec(efEnvelope, single=False):
+    """
+    Amplitude Envelope Correlation for all pairs of ROIs at once.
+
+    Envelopes are z-scored once per epoch and all Pearson correlations are obtained from one batched
+    matrix product across epochs.
+
+    :param efEnvelope: Amplitude envelope of Hilbert transform with shape [epochs x rois x time]
+    :param single: Use float32 for the matrix products (the epoch average is kept in float64)
+    :return: AEC matrix (rois, rois) averaged across epochs
+    """
+
+    efEnvelope = np.asarray(efEnvelope, dtype=np.float32 if single else np.float64)
+
+    # z-score along time
+    efEnvelope = efEnvelope - efEnvelope.mean(axis=-1, keepdims=True)
+    efEnvelope = efEnvelope / np.linalg.norm(efEnvelope, axis=-1, keepdims=True)
+
+    # Pearson's r of every pair and epoch: [epochs x rois x rois]
+    values_aec = np.matmul(efEnvelope, np.swapaxes(efEnvelope, -1, -2))
+
+    return np.average(values_aec, axis=0).astype(np.float64)
+
+
+def fc_corr(signals, single=False):
+    """
+    Correlation between signals from the Gram matrix of the standardized signals.
+
+    Signals are standardized once (across ROIs, as in fc(measure="CORR")) and the whole matrix is obtained
+    from a single matrix product.
+
+    :param signals: Signals with shape [rois x time]
+    :param single: Use float32 for the matrix product
+    :return: CORR matrix (rois, rois)
+    """
+
+    signals = np.asarray(signals, dtype=np.float32 if single else np.float64)
+
+    stdSignals = (signals - np.average(signals, axis=0)) / np.std(signals, axis=0)
+
+    fc_matrix = np.matmul(stdSignals, stdSignals.T) / stdSignals.shape[-1]
+
+    return fc_matrix.astype(np.float64)
+
+
 ## Dynamical functional connetivity
 def dynamic_fc(data, samplingFreq, transient, window, step, measure="PLV", plot=None, folder='figures',
-               lowcut=8, highcut=12, filtered=False, auto_open=False, verbose=False, mode="dFC"):
+               lowcut=8, highcut=12, filtered=False, auto_open=False, verbose=False, mode="dFC", hilbert="window",
+               container=False, single=None):
     """
     Calculates dynamical Functional Connectivity using the classical method of sliding windows.
 
@@ -144,53 +496,87 @@ def dynamic_fc(data, samplingFreq, transient, window, step, measure="PLV", plot=
     :param plot: Plot dFC matrix?
     :param folder: To save figures output
     :param auto_open: on browser.
+    :param mode: "dFC" returns the FCD matrix; "all_matrices" also returns the FC matrix per window;
+     "fcd_values" returns only the upper triangle of the FCD (i.e., the distribution used for KS comparisons)
+    :param hilbert: "window" gets the analytical signal per window; "global" gets it once for the whole recording
+     and obtains every window FC from running sums, so cost does not scale with window overlap.
+    :param container: With mode="all_matrices", return the FC matrices as a condensed Connectivity stack
+    :param single: Work in float32/complex64 from the filtered signals on (None: mnetools.set_precision default);
+     running sums are accumulated in float64
     :return: dFC matrix
     """
 
+    if hilbert not in ["window", "global"]:
+        raise ValueError("Unknown hilbert mode: %s. Use \"window\" or \"global\"." % hilbert)
+
     window_ = window * 1000
     step_ = step * 1000
+    single = mnetools.get_single(single)
 
     if len(data[0]) > window_:
         if filtered:
             filterSignals = data
         else:
             # Band-pass filtering
-            filterSignals = filter.filter_data(data, samplingFreq, lowcut, highcut, verbose=verbose)
+            filterSignals = band_filter(data, samplingFreq, lowcut, highcut, verbose=verbose)
+
+        # Transforms the filtered signals into single precision, if requested.
+        if single:
+            filterSignals = np.asarray(filterSignals, dtype=np.float32)
+
         if verbose:
             print("Calculating dFC matrix...")
 
-        matrices_fc = list()
-        for w in np.arange(0, (len(data[0])) - window_, step_, 'int'):
+        # Upper triangles (k=1) of the FC matrices, condensed window by window; the full matrices are only kept
+        # for mode="all_matrices" without container.
+        triu = np.triu_indices(len(data), 1)
+        keep = mode == "all_matrices" and not container
+        matrices_fc, edges_fc = list(), list()
+
+        if hilbert == "global":
+            # Padding as Hilbert transform has distortions at edges
+            padding = np.zeros((len(data), 1000), dtype=filterSignals.dtype)
+            analyticalSignal = signal.hilbert(np.concatenate([padding, filterSignals, padding], axis=1))[:, 1000:-1000]
 
-            if verbose:
-                print('%s %i / %i' % (measure, w / step_, ((len(data[0])) - window_) / step_))
+            for fc_matrix in _sliding_fc(analyticalSignal, int(window_), int(step_), measure=measure):
+                edges_fc.append(fc_matrix[triu])
+                matrices_fc.append(fc_matrix) if keep else None
 
-            efSignals = filterSignals[:, w:w + window_]
+        else:
+            for w in np.arange(0, (len(data[0])) - window_, step_, 'int'):
 
-            # Obtain Analytical signal
-            efPhase = list()
-            efEnvelope = list()
-            for i in range(len(efSignals)):
-                analyticalSignal = signal.hilbert(efSignals[i])
-                # Get instantaneous phase and amplitude envelope by channel
-                efPhase.append(np.unwrap(np.angle(analyticalSignal)))
-                efEnvelope.append(np.abs(analyticalSignal))
+                if verbose:
+                    print('%s %i / %i' % (measure, w / step_, ((len(data[0])) - window_) / step_))
 
-            # # Check point
-            # from toolbox.signals import timeseriesPlot, plotConversions
-            # regionLabels = conn.region_labels
-            # timeseriesPlot(data, raw_time, regionLabels)
-            # plotConversions(data[:, :len(efSignals[0])], efSignals, efPhase, efEnvelope, band="alpha", regionLabels=regionLabels)
+                efSignals = filterSignals[:, w:w + window_]
+
+                # Obtain Analytical signal
+                efPhase = list()
+                efEnvelope = list()
+                for i in range(len(efSignals)):
+                    analyticalSignal = signal.hilbert(efSignals[i])
+                    # Get instantaneous phase and amplitude envelope by channel
+                    efPhase.append(np.unwrap(np.angle(analyticalSignal)))
+                    efEnvelope.append(np.abs(analyticalSignal))
 
-            ef = "efPhase" if measure == "PLV" else "efEnvelope"
-            matrices_fc.append(fc(efPhase, ef=ef, measure=measure, verbose=verbose))
+                # # Check point
+                # from toolbox.signals import timeseriesPlot, plotConversions
+                # regionLabels = conn.region_labels
+                # timeseriesPlot(data, raw_time, regionLabels)
+                # plotConversions(data[:, :len(efSignals[0])], efSignals, efPhase, efEnvelope, band="alpha", regionLabels=regionLabels)
 
+                ef = "efPhase" if measure == "PLV" else "efEnvelope"
+                fc_matrix = fc(efPhase if measure == "PLV" else efEnvelope, ef=ef, measure=measure, verbose=verbose,
+                               single=single)
+                edges_fc.append(fc_matrix[triu])
+                matrices_fc.append(fc_matrix) if keep else None
 
-        dFC_matrix = np.zeros((len(matrices_fc), len(matrices_fc)))
-        for t1 in range(len(matrices_fc)):
-            for t2 in range(len(matrices_fc)):
-                dFC_matrix[t1, t2] = np.corrcoef(matrices_fc[t1][np.triu_indices(len(matrices_fc[0]), 1)],
-                                                 matrices_fc[t2][np.triu_indices(len(matrices_fc[0]), 1)])[1, 0]
+        edges_fc = np.asarray(edges_fc)
+
+        if mode == "fcd_values":
+            return fcd(edges_fc, values=True)
+
+        dFC_matrix = fcd(edges_fc)
 
         if plot:
             fig = go.Figure(
@@ -210,7 +596,10 @@ def dynamic_fc(data, samplingFreq, transient, window, step, measure="PLV", plot=
             elif plot == "inline":
                 plotly.offline.iplot(fig)
 
-        if mode == "all_matrices":
+        if mode == "all_matrices" and container:
+            # PLV and AEC matrices have a unit diagonal
+            return dFC_matrix, Connectivity(edges_fc, len(data), diagonal=False, method=measure, fill=1)
+        elif mode == "all_matrices":
             return dFC_matrix, matrices_fc
         else:
             return dFC_matrix
@@ -219,7 +608,189 @@ def dynamic_fc(data, samplingFreq, transient, window, step, measure="PLV", plot=
         print('Error: Signal length should be longer than window length (%i sec)' % window)
 
 
-def ple(efPhase, time_lag, pattern_size, samplingFreq, subsampling=1):
+def dynamic_fc_stream(data, samplingFreq, window, step, measure="PLV", lowcut=8, highcut=12, chunk=60,
+                      numtaps=None):
+    """
+    Sliding-window FC over recordings that do not fit in memory.
+
+    Signals are read in time blocks and filtered into the analytic signal (Hamming FIR + Hilbert in the
+    frequency domain, as in plv()) keeping only the samples needed across block borders: a margin of raw
+    signal on each side and the analytic samples of the current window. Each window FC is yielded as soon
+    as it is complete.
+
+    :param data: Signals in shape [ROIS x time] (e.g., np.memmap) or an iterator of [ROIS x samples] blocks
+    :param samplingFreq: sampling frequency (Hz)
+    :param window: Seconds of sliding window
+    :param step: Movement step for sliding window (seconds)
+    :param measure: FC measure (PLV; AEC)
+    :param chunk: Seconds read per block when data is an array
+    :param numtaps: FIR length; defaults to three cycles of lowcut
+    :return: generator of condensed FC vectors (upper triangle, k=1) one per window
+    """
+
+    if measure not in ["PLV", "AEC"]:
+        raise ValueError("Streaming dFC only implemented for PLV and AEC.")
+
+    window_, step_ = int(window * samplingFreq), int(step * samplingFreq)
+
+    if numtaps is None:
+        numtaps = int(3 * samplingFreq / lowcut)
+    num = bandpass_fir(numtaps, (lowcut, highcut), samplingFreq)
+
+    # Samples of context needed around the filtered output (two-pass FIR + Hilbert tails).
+    margin = 2 * numtaps
+
+    if isinstance(data, np.ndarray):
+        chunk_ = int(chunk * samplingFreq)
+        blocks = (data[:, t:t + chunk_] for t in range(0, data.shape[-1], chunk_))
+    else:
+        blocks = iter(data)
+
+    raw, rawstart = None, 0  # Pending raw samples and absolute index of the first one
+    analytic, anstart = None, 0  # Analytic samples not yet consumed by windows
+    done, w = 0, 0  # Absolute end of the analytic output and start of the next window
+
+    for block in itertools.chain(blocks, [None]):
+        final = block is None
+
+        if not final:
+            block = np.asarray(block, dtype=np.float64)
+            raw = block if raw is None else np.concatenate([raw, block], axis=1)
+
+        if raw is None:
+            return
+
+        # Waits for enough look-ahead beyond the next output sample.
+        if not final and raw.shape[-1] < done - rawstart + 2 * margin:
+            continue
+
+        # Filters the pending data and keeps the samples away from the block borders.
+        out0, out1 = done - rawstart, raw.shape[-1] if final else raw.shape[-1] - margin
+        if out1 > out0:
+            filtered = mnetools.signal_filtfilt(raw, num=num, hilbert=True)[:, out0:out1]
+            analytic = filtered if analytic is None else np.concatenate([analytic, filtered], axis=1)
+            done = rawstart + out1
+
+        # Drops the raw samples no longer needed as context.
+        keep = max(0, done - margin - rawstart)
+        raw, rawstart = raw[:, keep:], rawstart + keep
+
+        # Yields every complete window.
+        while w + window_ < done:
+            segment = analytic[:, w - anstart:w + window_ - anstart]
+
+            if measure == "PLV":
+                fc_matrix = fc_plv(np.angle(segment)[np.newaxis])
+            else:
+                fc_matrix = fc_aec(np.abs(segment)[np.newaxis])
+
+            yield fc_matrix[np.triu_indices(len(fc_matrix), 1)]
+            w += step_
+
+        # Drops the analytic samples before the next window (only up to done, as w can be ahead of the output
+        # when step > window, so the next filtered samples keep starting at anstart + analytic.shape[-1]).
+        if analytic is not None:
+            skip = min(w, done) - anstart
+            analytic, anstart = analytic[:, skip:], anstart + skip
+
+
+def fcd(matrices_fc, values=False, mem_limit=MEMLIMIT):
+    """
+    Functional Connectivity Dynamics: correlation between the upper triangles of every pair of FC matrices.
+
+    The upper triangles are stacked into a contiguous [windows x edges] array and z-scored once, and the FCD
+    is obtained by matrix products over blocks of windows sized to mem_limit bytes.
+
+    :param matrices_fc: list (or array) of FC matrices, one per window, or their condensed upper triangles (k=1)
+     as a [windows x edges] array
+    :param values: Return only the upper triangle values (k=1) of the FCD instead of the full matrix
+    :return: FCD matrix [windows x windows] or array of FCD values
+    """
+
+    matrices_fc = np.asarray(matrices_fc)
+    n_windows = len(matrices_fc)
+
+    # Upper triangles as windows x edges, z-scored by window
+    if matrices_fc.ndim == 2:
+        edges = matrices_fc
+    else:
+        triu = np.triu_indices(matrices_fc.shape[-1], 1)
+        edges = matrices_fc[:, triu[0], triu[1]]
+    edges = edges - edges.mean(axis=-1, keepdims=True)
+    edges = edges / np.linalg.norm(edges, axis=-1, keepdims=True)
+
+    block = int(max(1, mem_limit // (8 * n_windows)))
+
+    dFC_matrix = None if values else np.zeros((n_windows, n_windows))
+    dFC_values = list()
+    for b0 in range(0, n_windows, block):
+        b1 = min(b0 + block, n_windows)
+
+        # Pearson's r between this block of windows and the following ones
+        rows = np.matmul(edges[b0:b1], edges[b0:].T)
+
+        if values:
+            dFC_values += [rows[i, i + 1:] for i in range(b1 - b0)]
+        else:
+            dFC_matrix[b0:b1, b0:] = rows
+            dFC_matrix[b0:, b0:b1] = rows.T
+
+    return np.concatenate(dFC_values) if values else dFC_matrix
+
+
+def sliding_fc(analyticalSignal, window, step, measure="PLV"):
+    """
+    FC matrices (PLV or AEC) of sliding windows over a single analytical signal.
+
+    Window sums of phasor products (PLV) or of envelope moments (AEC) are updated by adding the samples
+    entering the window and removing those leaving it, so the total cost is O(rois^2 x time) whatever the
+    overlap between windows.
+
+    :param analyticalSignal: Analytical signal in shape [ROIS x time]
+    :param window: Window length (samples)
+    :param step: Window step (samples)
+    :param measure: "PLV" or "AEC"
+    :return: list of FC matrices, one per window
+    """
+
+    return list(_sliding_fc(analyticalSignal, window, step, measure=measure))
+
+
+def _sliding_fc(analyticalSignal, window, step, measure="PLV"):
+    """ Generator of the sliding_fc() matrices, one window at a time."""
+
+    if measure == "PLV":
+        values = np.exp(1j * np.angle(analyticalSignal))
+    elif measure == "AEC":
+        values = np.abs(analyticalSignal)
+    else:
+        raise ValueError("Sliding FC only implemented for PLV and AEC.")
+
+    # Running sums are kept in double precision, even for single precision signals.
+    dtype = np.result_type(values.dtype, np.float64)
+
+    def moments(t0, t1):
+        segment = values[:, t0:t1]
+        return np.matmul(segment, segment.T.conj()).astype(dtype, copy=False), segment.sum(axis=-1, dtype=dtype)
+
+    for w in np.arange(0, values.shape[-1] - window, step, 'int'):
+
+        # Updates the running sums (or restarts them if windows do not overlap).
+        if w == 0 or step >= window:
+            sum2, sum1 = moments(w, w + window)
+        else:
+            enter, leave = moments(w + window - step, w + window), moments(w - step, w)
+            sum2, sum1 = sum2 + enter[0] - leave[0], sum1 + enter[1] - leave[1]
+
+        if measure == "PLV":
+            yield np.abs(sum2) / window
+        else:
+            cov = sum2.real - np.outer(sum1, sum1) / window
+            std = np.sqrt(np.diag(cov))
+            yield cov / np.outer(std, std)
+
+
+def ple(efPhase, time_lag, pattern_size, samplingFreq, subsampling=1, mem_limit=MEMLIMIT, engine="numpy"):
     """
     It calculates Phase Lag Entropy (Lee et al., 2017) on a bunch of filtered and epoched signals with shape [epoch,rois,time]
     It is based on the diversity of temporal patterns between two signals phases.
@@ -235,6 +806,9 @@ def ple(efPhase, time_lag, pattern_size, samplingFreq, subsampling=1):
         occurs in a given epoch and
         - m is pattern size.
 
+    Patterns are encoded as integers (first element as the most significant bit) and counted with np.bincount,
+    vectorized over epochs and blocks of channels sized to mem_limit bytes.
+
     REFERENCE ||  Lee et al. (2017) Diversity of FC patterns is reduced during anesthesia.
 
 
@@ -244,39 +818,47 @@ def ple(efPhase, time_lag, pattern_size, samplingFreq, subsampling=1):
     :param samplingFreq: signal sampling frequency
     :param subsampling: If your signal has high temporal resolution, maybe gathering all possible patters is not
      efficient, thus you can omit some timepoints between gathered patterns
+    :param engine: "numpy" or "numba" (compiled pattern counting over all pairs, without temporaries)
 
-    :return: PLE - matrix shape (rois, rois) with PLE values for each couple; patts - patterns i.e. all the patterns
-    registered in the signal and the number of times they appeared.
+    :return: PLE - matrix shape (rois, rois) with PLE values for each couple; patts - counts array shape
+    (rois, rois, epochs, 2^m) with the number of times each pattern (integer code) appeared.
     """
 
     tic = time.time()
     try:
         efPhase[0][0][0]  # Test whether signals have been epoched
-        PLE = np.ndarray((len(efPhase[0]), len(efPhase[0])))
+        efPhase = np.asarray(efPhase)
+        n_epochs, n_rois, n_samples = efPhase.shape
+        PLE = np.ndarray((n_rois, n_rois))
 
         time_lag = int(np.trunc(time_lag * samplingFreq / 1000))  # translate time lag in timepoints
-        patts = list()
+        n_patterns = len(np.arange(0, n_samples - time_lag * pattern_size, step=subsampling))
+        patts = np.zeros((n_rois, n_rois, n_epochs, 2 ** pattern_size), dtype=np.min_scalar_type(n_patterns))
+
         print("Calculating PLE ", end="")
-        for channel1 in range(len(efPhase[0])):
+
+        if kernels.resolve_engine(engine) == "numba":
+            kernels.ple_pairs(efPhase, time_lag, pattern_size, subsampling, patts)
+            PLE[:] = np.average(ple_entropy(patts, pattern_size), axis=-1)
+
+            print("%0.3f seconds.\n" % (time.time() - tic,))
+
+            return PLE, patts
+
+        # Phase differences (float64), binarized (bool) and encoded (int64) for a block of channels
+        block = int(max(1, mem_limit // (17 * n_epochs * n_samples)))
+
+        for channel1 in range(n_rois):
             print(".", end="")
-            for channel2 in range(len(efPhase[0])):
-                ple_values = list()
-                for epoch in range(len(efPhase)):
-                    phaseDifference = efPhase[epoch][channel1] - efPhase[epoch][channel2]
-
-                    # Binarize to create the pattern and comprehend into list
-                    patterns = [str(np.where(phaseDifference[t: t + time_lag * pattern_size: time_lag] > 0, 1, 0)) for t
-                                in
-                                np.arange(0, len(phaseDifference) - time_lag * pattern_size, step=subsampling)]
-                    patt_counts = Counter(patterns)
-                    patts.append(patt_counts)
-                    summation = 0
-                    for key, value in patt_counts.items():
-                        p = value / len(patterns)
-                        summation += p * np.log10(p)
-
-                    ple_values.append((-1 / np.log10(2 ** pattern_size)) * summation)
-                PLE[channel1, channel2] = np.average(ple_values)
+            for b0 in range(0, n_rois, block):
+                b1 = min(b0 + block, n_rois)
+                phaseDifference = efPhase[:, [channel1]] - efPhase[:, b0:b1]
+
+                # Pattern counts [epochs x block x 2^m] and entropy per epoch
+                patt_counts = ple_counts(phaseDifference, time_lag, pattern_size, subsampling)
+                patts[channel1, b0:b1] = np.swapaxes(patt_counts, 0, 1)
+                PLE[channel1, b0:b1] = np.average(ple_entropy(patt_counts, pattern_size), axis=0)
+
         print("%0.3f seconds.\n" % (time.time() - tic,))
 
         return PLE, patts
@@ -285,6 +867,117 @@ def ple(efPhase, time_lag, pattern_size, samplingFreq, subsampling=1):
         print("IndexError. Signals must be epoched. Use epochingTool().")
 
 
+def ple_parallel(efPhase, time_lag, pattern_size, samplingFreq, subsampling=1, n_jobs=None, block=None,
+                 mem_limit=MEMLIMIT, verbose=True):
+    """
+    Parallel Phase Lag Entropy for large parcellations; same inputs and outputs as ple().
+
+    Only unordered pairs of channels are visited: the patterns of (j, i) are the bitwise complement of those of
+    (i, j), thus PLE(j, i) = PLE(i, j) and their counts are mirrored along the pattern axis (up to exactly null
+    phase differences). Pairs are split into blocks handed to a process pool that reads the phases from shared
+    memory, and per-block results are gathered as they complete.
+
+    :param n_jobs: Number of worker processes (default: number of CPUs)
+    :param block: Pairs per block; by default sized so each worker stays within mem_limit bytes
+    :return: PLE - matrix shape (rois, rois); patts - counts array shape (rois, rois, epochs, 2^m)
+    """
+
+    tic = time.time()
+    efPhase = np.ascontiguousarray(efPhase, dtype=np.float64)
+    n_epochs, n_rois, n_samples = efPhase.shape
+
+    time_lag = int(np.trunc(time_lag * samplingFreq / 1000))  # translate time lag in timepoints
+    n_patterns = len(np.arange(0, n_samples - time_lag * pattern_size, step=subsampling))
+
+    PLE = np.zeros((n_rois, n_rois))
+    patts = np.zeros((n_rois, n_rois, n_epochs, 2 ** pattern_size), dtype=np.min_scalar_type(n_patterns))
+
+    # Null phase differences: a single pattern (code 0) and null entropy
+    patts[np.arange(n_rois), np.arange(n_rois), :, 0] = n_patterns
+
+    pairs = np.array(np.triu_indices(n_rois, 1))
+    if block is None:
+        block = int(max(1, mem_limit // (17 * n_epochs * n_samples)))
+
+    # Shares the phases with the workers
+    shm = shared_memory.SharedMemory(create=True, size=efPhase.nbytes)
+    try:
+        np.ndarray(efPhase.shape, dtype=efPhase.dtype, buffer=shm.buf)[:] = efPhase
+
+        print("Calculating PLE ", end="") if verbose else None
+        # Spawned (not forked) workers, as forking after numba kernels have run (kernels) can deadlock
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_ple_attach, initargs=(shm.name, efPhase.shape),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = [executor.submit(_ple_block, pairs[:, b0:b0 + block], time_lag, pattern_size, subsampling)
+                       for b0 in range(0, pairs.shape[-1], block)]
+
+            for future in as_completed(futures):
+                print(".", end="") if verbose else None
+                (rows, cols), values, counts = future.result()
+
+                PLE[rows, cols], PLE[cols, rows] = values, values
+                patts[rows, cols], patts[cols, rows] = counts, counts[..., ::-1]
+        print("%0.3f seconds.\n" % (time.time() - tic,)) if verbose else None
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return PLE, patts
+
+
+def _ple_attach(name, shape):
+    global _ple_shm, _ple_phase
+    _ple_shm = shared_memory.SharedMemory(name=name)
+    _ple_phase = np.ndarray(shape, dtype=np.float64, buffer=_ple_shm.buf)
+
+
+def _ple_block(pairs, time_lag, pattern_size, subsampling):
+    phaseDifference = _ple_phase[:, pairs[0]] - _ple_phase[:, pairs[1]]
+
+    patt_counts = np.swapaxes(ple_counts(phaseDifference, time_lag, pattern_size, subsampling), 0, 1)
+
+    return pairs, np.average(ple_entropy(patt_counts, pattern_size), axis=-1), patt_counts
+
+
+def ple_counts(phaseDifference, time_lag, pattern_size, subsampling=1):
+    """
+    Counts the binary patterns of the phase differences along the last axis.
+
+    :param phaseDifference: Phase differences with shape [... x time]
+    :param time_lag: temporal distance between elements in pattern (timepoints)
+    :param pattern_size: number of elements in each pattern
+    :param subsampling: step between gathered patterns (timepoints)
+    :return: counts with shape [... x 2^pattern_size]; index is the pattern read as a binary number
+    """
+
+    binary = np.asarray(phaseDifference) > 0
+    n_patterns = len(np.arange(0, binary.shape[-1] - time_lag * pattern_size, step=subsampling))
+
+    # Encodes each pattern as an integer by bit-shifting its elements
+    codes = np.zeros(binary.shape[:-1] + (n_patterns,), dtype=np.int64)
+    for k in range(pattern_size):
+        codes <<= 1
+        codes |= binary[..., k * time_lag: k * time_lag + (n_patterns - 1) * subsampling + 1: subsampling]
+
+    # A single bincount for all leading dimensions by offsetting their codes
+    n_codes, n_lead = 2 ** pattern_size, int(np.prod(codes.shape[:-1]))
+    codes = codes.reshape((n_lead, n_patterns)) + n_codes * np.arange(n_lead)[:, np.newaxis]
+    counts = np.bincount(codes.reshape(-1), minlength=n_lead * n_codes)
+
+    return counts.reshape(binary.shape[:-1] + (n_codes,))
+
+
+def ple_entropy(counts, pattern_size):
+    """ Normalized Shannon entropy (PLE) from pattern counts with shape [... x 2^pattern_size]."""
+
+    p = counts / np.sum(counts, axis=-1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        summation = np.sum(np.where(p > 0, p * np.log10(p), 0), axis=-1)
+
+    return (-1 / np.log10(2 ** pattern_size)) * summation
+
+
 ## Metastability
 def kuramoto_order(data, samplingFreq, lowcut=8, highcut=12, filtered=False, verbose=False):
     """
@@ -293,23 +986,9 @@ def kuramoto_order(data, samplingFreq, lowcut=8, highcut=12, filtered=False, ver
     """
     if verbose:
         print("Calculating Kuramoto order paramter...")
-    if filtered:
-        filterSignals = data
-
-    else:
-        # Band-pass filtering
-        filterSignals = filter.filter_data(data, samplingFreq, lowcut, highcut, verbose=verbose)
-
-    # Padding as Hilbert transform has distortions at edges
-    padding = np.zeros((len(data), 1000))
-
-    filterSignals_padded = np.concatenate([padding, filterSignals, padding], axis=1)
 
-    analyticalSignal_padded = signal.hilbert(filterSignals_padded)
-    # Get instantaneous phase by channel
-    efPhase_padded = np.angle(analyticalSignal_padded)
-
-    efPhase = efPhase_padded[:, 1000:-1000]
+    # Band-pass filtering and instantaneous phase (padded Hilbert transform)
+    efPhase = analytic_padded(data, samplingFreq, lowcut, highcut, filtered=filtered, verbose=verbose)
 
     # Kuramoto order parameter in time
     kuramoto_array = abs(np.sum(np.exp(1j * efPhase), axis=0)) / len(efPhase)
@@ -320,30 +999,78 @@ def kuramoto_order(data, samplingFreq, lowcut=8, highcut=12, filtered=False, ver
     return kuramoto_array, kuramoto_sd, kuramoto_avg
 
 
-def kuramoto_polar(data, time_, samplingFreq, speed, lowcut=8, highcut=10, timescale="ms",
-                   mode="html", folder="figures", title="", auto_open=True):
-    # Band-pass filtering
-    filterSignals = filter.filter_data(data, samplingFreq, lowcut, highcut, verbose=False)
+def kuramoto_order_batch(data, samplingFreq, bands=((8, 12),), filtered=False, padding=1000, verbose=False):
+    """
+    Kuramoto order (synchrony) and metastability for a batch of simulations and bands in one vectorized pass.
 
-    # Padding as Hilbert transform has distortions at edges
-    padding = np.zeros((len(data), 1000))
+    All simulations are filtered together with a single filter design per band. Instead of zero padding both
+    sides explicitly, signals are padded on the left and the Hilbert transform is zero padded on the right up to
+    a fast FFT length (scipy.fft.next_fast_len) of at least padding samples.
 
-    filterSignals_padded = np.concatenate([padding, filterSignals, padding], axis=1)
+    :param data: Signals in shape [sims x ROIS x time] or list of [ROIS x time] arrays
+    :param samplingFreq: sampling frequency (Hz)
+    :param bands: dict {name: (lowcut, highcut)} or list of (lowcut, highcut) tuples
+    :param filtered: data already filtered (bands are then ignored)
+    :return: kuramoto_sd (metastability), kuramoto_avg (synchrony) with shape [sims x bands]
+    """
 
-    analyticalSignal_padded = signal.hilbert(filterSignals_padded)
-    # Get instantaneous phase by channel
-    efPhase_padded = np.angle(analyticalSignal_padded)
+    data = np.asarray(data)
+    n_sims, n_rois, n_samples = data.shape
 
-    phases = efPhase_padded[:, 1000:-1000]
+    if filtered:
+        bands = [None]
+    elif isinstance(bands, dict):
+        bands = list(bands.values())
 
+    nfft = fft.next_fast_len(n_samples + 2 * padding)
+
+    kuramoto_sd, kuramoto_avg = np.zeros((n_sims, len(bands))), np.zeros((n_sims, len(bands)))
+    for b, band in enumerate(bands):
+        if verbose:
+            print("Calculating Kuramoto order paramter for %s band..." % (band,))
+
+        # Band-pass filtering of all simulations at once
+        signals = data.reshape((-1, n_samples))
+        if band is not None:
+            signals = band_filter(signals, samplingFreq, band[0], band[1], verbose=verbose)
+
+        # Left padding; the right padding is added by the Hilbert transform
+        signals = np.concatenate([np.zeros((len(signals), padding)), signals], axis=1)
+        efPhase = np.angle(signal.hilbert(signals, N=nfft, axis=-1)[:, padding:padding + n_samples])
+
+        # Kuramoto order parameter in time per simulation
+        kuramoto_array = np.abs(np.mean(np.exp(1j * efPhase.reshape((n_sims, n_rois, n_samples))), axis=1))
+
+        kuramoto_avg[:, b] = np.average(kuramoto_array, axis=-1)
+        kuramoto_sd[:, b] = np.std(kuramoto_array, axis=-1)
+
+    return kuramoto_sd, kuramoto_avg
+
+
+def kuramoto_polar(data, time_, samplingFreq, speed, lowcut=8, highcut=10, timescale="ms",
+                   mode="html", folder="figures", title="", auto_open=True, max_frames=500):
+    """
+    Animated polar plot of the ROIs phases and the Kuramoto order parameter.
+
+    :param speed: Keep one every speed timepoints
+    :param max_frames: Frame budget; time is further decimated so that the animation has at most max_frames
+     frames. Frame data are stored as float32 arrays (compact typed arrays in the exported figure).
+    """
+    # Band-pass filtering and instantaneous phase (padded Hilbert transform)
+    phases = analytic_padded(data, samplingFreq, lowcut, highcut)
+
+    # Adaptive time decimation to fit the frame budget
+    speed = max(speed, math.ceil(phases.shape[-1] / max_frames))
     phases = phases[:, ::speed]
-    time_ = time_[::speed]
+    time_ = np.asarray(time_)[::speed]
+    labels = [str(np.round(t, 3)) for t in time_]
 
-    kuramoto_order = [1 / len(phases) * np.sum(np.exp(1j * phases[:, i])) for i, dp in enumerate(phases[0])]
-    KO_magnitude = np.abs(kuramoto_order)
-    KO_angle = np.angle(kuramoto_order)
+    kuramoto_order = np.mean(np.exp(1j * phases), axis=0)
+    KO_magnitude = np.abs(kuramoto_order).astype(np.float32)
+    KO_angle = np.angle(kuramoto_order).astype(np.float32)
 
-    wraped_phase = (phases % (2 * np.pi))
+    # Frames x ROIs, contiguous float32
+    wraped_phase = np.ascontiguousarray((phases % (2 * np.pi)).T, dtype=np.float32)
     cmap = (px.colors.qualitative.Plotly + px.colors.qualitative.Light24 + px.colors.qualitative.Set2 +
             px.colors.qualitative.Dark24 + px.colors.qualitative.Set1 + px.colors.qualitative.Pastel2 +
             px.colors.qualitative.Set3 + px.colors.qualitative.Light24 + px.colors.qualitative.Pastel1 +
@@ -359,12 +1086,12 @@ def kuramoto_polar(data, time_, samplingFreq, speed, lowcut=8, highcut=10, times
                                   name="KO", mode="markers", marker=dict(size=6, color="darkslategray")))
 
     ## Add each region phase
-    fig.add_trace(go.Scatterpolar(theta=wraped_phase[:, 0], r=[1] * len(wraped_phase), thetaunit="radians",
-                                  name="ROIs", mode="markers", marker=dict(size=8, color=cmap), opacity=0.8))
+    fig.add_trace(go.Scatterpolar(theta=wraped_phase[0], r=np.ones(len(phases), dtype=np.float32), thetaunit="radians",
+                                  name="ROIs", mode="markers", marker=dict(size=8, color=cmap[:len(phases)]), opacity=0.8))
 
-    fig.update(frames=[go.Frame(data=[go.Scatterpolar(theta=[KO_angle[i]], r=[KO_magnitude[i]]),
-                                      go.Scatterpolar(theta=wraped_phase[:, i])],
-                                traces=[0, 1], name=str(np.round(t, 3))) for i, t in enumerate(time_)])
+    fig.update(frames=[go.Frame(data=[go.Scatterpolar(theta=KO_angle[i:i + 1], r=KO_magnitude[i:i + 1]),
+                                      go.Scatterpolar(theta=wraped_phase[i])],
+                                traces=[0, 1], name=label) for i, label in enumerate(labels)])
 
     # CONTROLS : Add sliders and buttons
     fig.update_layout(template="plotly_white", height=400, width=500, polar=dict(angularaxis_thetaunit="radians", ),
@@ -372,10 +1099,10 @@ def kuramoto_polar(data, time_, samplingFreq, speed, lowcut=8, highcut=10, times
                       sliders=[dict(
                           steps=[
                               dict(method='animate',
-                                   args=[[str(t)], dict(mode="immediate",
-                                                        frame=dict(duration=0, redraw=True, easing="cubic-in-out"),
-                                                        transition=dict(duration=0))], label=str(np.round(t, 3))) for
-                              i, t in enumerate(time_)],
+                                   args=[[label], dict(mode="immediate",
+                                                       frame=dict(duration=0, redraw=True, easing="cubic-in-out"),
+                                                       transition=dict(duration=0))], label=label) for
+                              label in labels],
                           transition=dict(duration=0), xanchor="left", x=0.35, y=-0.15,
                           currentvalue=dict(font=dict(size=15, color="black"), prefix="Time (%s) - " % (timescale),
                                             visible=True,
@@ -413,7 +1140,15 @@ Efficient implmentation of PLV, COH and AEC, with source leakage corrected versi
 
 Edited on 08/10/24 by @Jescab01.
 """
-def plv(data, band=None, padding=None, average=True):
+def plv(data, band=None, padding=None, average=True, single=None, mem_limit=MEMLIMIT, container=False):
+    """
+    single=True (or None with mnetools.set_precision(True)) keeps the data in complex64 from the filtering to
+    the PLV matrices; the average across repetitions is accumulated in float64.
+    """
+
+    # Gets the precision of the call.
+    single = mnetools.get_single(single)
+
     # Checks whether the data is a valid MNE object.
     # For now, it only works with sensor-space data.
     if not (isinstance(data, mnetools.mnevalid)):
@@ -446,10 +1181,10 @@ def plv(data, band=None, padding=None, average=True):
             padding = data.time_as_index(0)[0]
 
         # Defines the filter.
-        num = signal.firwin(padding, band, fs=data.info['sfreq'], window='hamming', pass_zero='bandpass')
+        num = bandpass_fir(padding, band, data.info['sfreq'])
 
         # Filters the epoched data using Hilbert filtering.
-        data = mnetools.filtfilt(data, num=num, hilbert=True)
+        data = mnetools.filtfilt(data, num=num, hilbert=True, single=single)
 
         # Removes the padding.
         if padding and padding > 0:
@@ -469,6 +1204,10 @@ def plv(data, band=None, padding=None, average=True):
     rawdata = rawdata.reshape([-1, nchan, nsamp])
     nrep = rawdata.shape[0]
 
+    # Transforms the data into single precision, if requested.
+    if single:
+        rawdata = mnetools.as_single(rawdata)
+
     # Normalizes the complex array.
     tiny = np.finfo(rawdata.dtype).tiny
     rawnorm = rawdata / (np.abs(rawdata) + tiny)
@@ -477,37 +1216,44 @@ def plv(data, band=None, padding=None, average=True):
     nodes = data.ch_names
     nnode = nchan
 
-    # Initializes the complex PLV matrix.
-    cplv = np.zeros((nrep, nnode, nnode), dtype=np.complex128)
+    # Defines the upper diagonal (and the diagonal within it).
+    triu = np.triu_indices(nnode, k=0)
+    diag = triu[0] == triu[1]
 
-    # Gets the complex PLV by matrix multiplication.
-    for i in range(nrep):
-        cplv[i] = np.inner(rawnorm[i], rawnorm[i].conj()) / nsamp
+    # Sets the number of repetitions per chunk to fit the complex PLV matrices in memory.
+    chunk = int(max(1, mem_limit // (3 * nnode * nnode * rawnorm.itemsize)))
 
-    # Recovers the original shape of the data.
-    cplv = cplv.reshape(shape[:-2] + (nnode, nnode))
+    # Initializes the outputs (as sums if averaging).
+    rtype = rawnorm.real.dtype
+    plv = np.zeros(triu[0].size if average else (nrep, triu[0].size), dtype=np.float64 if average else rtype)
+    ciplv = np.zeros_like(plv)
 
-    # Calculates the PLV and its corrected imaginary counterpart.
-    plv = np.abs(cplv)
-    iplv = np.imag(cplv)
-    rplv = np.real(cplv)
-    ciplv = abs(iplv / np.sqrt(np.maximum(1 - rplv * rplv, tiny)))
+    # Goes through each chunk of repetitions.
+    for r0 in range(0, nrep, chunk):
+        r1 = min(r0 + chunk, nrep)
 
-    # Forces the diagonal of ciPLV to 0.
-    diag = np.diag_indices(nnode)
-    ciplv[..., diag[0], diag[1]] = 0
+        # Gets the complex PLV by batched matrix multiplication.
+        cplv = np.matmul(rawnorm[r0:r1], np.swapaxes(rawnorm[r0:r1], -1, -2).conj()) / nsamp
 
-    # Flattens the connectivity matrices.
-    plv = plv.reshape((nrep, nnode * nnode))
-    ciplv = ciplv.reshape((nrep, nnode * nnode))
+        # Keeps only the upper triangular.
+        cplv = cplv[:, triu[0], triu[1]]
 
-    # Defines the upper diagonal in the flattened data.
-    triu = np.triu_indices(nnode, k=0)
-    triu = np.ravel_multi_index(triu, (nnode, nnode))
+        # Calculates the PLV and its corrected imaginary counterpart.
+        cplvabs = np.abs(cplv)
+        iplv = np.imag(cplv)
+        rplv = np.real(cplv)
+        cciplv = abs(iplv / np.sqrt(np.maximum(1 - rplv * rplv, tiny)))
 
-    # Keeps only the upper triangular.
-    plv = plv[:, triu]
-    ciplv = ciplv[:, triu]
+        # Forces the diagonal of ciPLV to 0.
+        cciplv[:, diag] = 0
+
+        # Accumulates or stores the values.
+        if average:
+            plv += cplvabs.sum(axis=0, dtype=np.float64)
+            ciplv += cciplv.sum(axis=0, dtype=np.float64)
+        else:
+            plv[r0:r1] = cplvabs
+            ciplv[r0:r1] = cciplv
 
     # # Creates the epoched connectivity objects.
     # plv = mne_connectivity.EpochConnectivity(
@@ -528,27 +1274,79 @@ def plv(data, band=None, padding=None, average=True):
 
     # Averages the epochs connectivity, if requested.
     if average:
-        plv = np.average(plv, axis=0)
-        ciplv = np.average(ciplv, axis=0)
+        plv = plv / nrep
+        ciplv = ciplv / nrep
+
+    # Creates the connectivity objects, if requested.
+    if container:
+        plv = Connectivity(plv, nnode, labels=nodes, method='Temporal PLV')
+        ciplv = Connectivity(ciplv, nnode, labels=nodes, method='Temporal ciPLV')
 
     # Returns the estimated connectivity.
     return plv, ciplv
 
 
-def coh(data, band=None, padding=None, average=True, faverage=True):
+def coh(data, band=None, padding=None, average=True, faverage=True, mem_limit=MEMLIMIT, container=False,
+        single=None):
     """
     Corrected imaginary part of coherence taken from:
     * Ewald et al. 2012 NeuroImage 60:476-488 Eq. 19.
+
+    Cross-spectra are accumulated over chunks of windows (sized to mem_limit bytes) taken as zero-copy strided
+    views of the data, and only for the upper triangle, so memory does not depend on the number of windows.
+
+    band can be a list of (fmin, fmax) tuples: the windowed spectra are computed once and the coherence is
+    averaged within each band, returning arrays with shape bands x edges (bands x repetitions x edges if
+    average=False).
+
+    Wrapper of spectral_fc() returning the magnitude-squared coherence and its corrected imaginary counterpart.
     """
 
+    values = spectral_fc(data, band=band, padding=padding, measures=("MSC", "ciCOH"), average=average,
+                         faverage=faverage, mem_limit=mem_limit, container=container, single=single)
+
+    # Returns the estimated connectivity.
+    return values["MSC"], values["ciCOH"]
+
+
+def spectral_fc(data, band=None, padding=None, measures=("MSC", "ciCOH", "iCOH", "wPLI"), average=True,
+                faverage=True, mem_limit=MEMLIMIT, container=False, single=None):
+    """
+    Spectral connectivity measures from a single pass of the Welch cross-spectral density (fft.welch_csd):
+    * MSC: magnitude-squared coherence.
+    * ciCOH: corrected imaginary part of coherence (Ewald et al. 2012 NeuroImage 60:476-488 Eq. 19).
+    * iCOH: imaginary part of coherency (Nolte et al. 2004 Clin Neurophysiol 115:2292-2307).
+    * wPLI: weighted phase lag index (Vinck et al. 2011 NeuroImage 55:1548-1565).
+    * dwPLI: debiased squared weighted phase lag index (Vinck et al. 2011).
+
+    The measures are computed per frequency from the same window-averaged spectra and averaged within the band
+    (or within each band, if a list of (fmin, fmax) tuples is provided). The output shapes are those of coh().
+
+    single=True (or None with mnetools.set_precision(True)) computes the windowed spectra in float32/complex64;
+    the spectra are averaged across windows in float64.
+
+    :return: dict with the requested measures
+    """
+
+    # Gets the precision of the call.
+    single = mnetools.get_single(single)
+
     # Checks whether the data is a valid MNE object.
     if not (isinstance(data, mnetools.mnevalid)):
         raise TypeError('Unsupported data type.')
 
+    unknown = set(measures) - {"MSC", "ciCOH", "iCOH", "wPLI", "dwPLI"}
+    if unknown:
+        raise ValueError('Unsupported spectral measures: %s.' % ", ".join(sorted(unknown)))
+
     # Checks the input.
     if band is None:
         band = (0, np.inf)
 
+    # Lists the bands, if several are provided.
+    multiband = np.ndim(band) == 2
+    bands = np.array(band, ndmin=2)
+
     # Makes a copy of the input to work with.
     data = data.copy()
 
@@ -578,7 +1376,6 @@ def coh(data, band=None, padding=None, average=True, faverage=True):
     rawdata = data.get_data()
 
     # Gets the metadata.
-    shape = rawdata.shape
     nsamp = rawdata.shape[-1]
     nchan = rawdata.shape[-2]
 
@@ -586,6 +1383,10 @@ def coh(data, band=None, padding=None, average=True, faverage=True):
     rawdata = rawdata.reshape([-1, nchan, nsamp])
     nrep = rawdata.shape[0]
 
+    # Transforms the data into single precision, if requested.
+    if single:
+        rawdata = mnetools.as_single(rawdata)
+
     # Gets the default window length and overlap.
     winlen = int(nsamp / 9 * 2)
     overlap = int(winlen / 2)
@@ -597,109 +1398,113 @@ def coh(data, band=None, padding=None, average=True, faverage=True):
     nodes = data.ch_names
     nnode = nchan
 
-    # Initialzies the windowed data matrix.
-    windata = np.zeros((nwin, nrep, nnode, winlen))
-
-    # Goes through each window.
-    for index in range(nwin):
-        # Calculates the window offset in the epoch.
-        offset = index * (winlen - overlap)
-
-        # Gets the data.
-        windata[index] = rawdata[None, ..., offset: offset + winlen]
-
-    # Applies the tapper.
-    windata = windata * signal.hamming(winlen)
-
     # Calculates the size of the Fourier transform.
     nfft = int(2 ** np.ceil(np.log2(winlen)))
     nfft = np.max((nfft, 256))
 
-    # Calculates the Fourier transform of the data.
-    fdata = fft.fft(windata, n=nfft, axis=-1, workers=-1)
+    # Gets the window-averaged auto- and cross-spectra (Hamming tapper).
+    wpli = "wPLI" in measures or "dwPLI" in measures
+    spectra = welch_csd(rawdata, data.info['sfreq'], winlen, winlen - overlap, nwin=nwin, nfft=nfft,
+                        taper="hamming", bands=bands, wpli=wpli, mem_limit=mem_limit)
+    freqs = spectra["freqs"]
+    nfreq = freqs.size
 
-    # Keeps only the desired part of the spectrum.
-    freqs = fft.fftfreq(nfft, 1 / data.info['sfreq'])
-    findex = (band[0] <= freqs) & (freqs <= band[1])
-    fdata = fdata[..., findex]
-    freqs = freqs[findex]
-    nfreq = fdata.shape[-1]
-
-    # Gets the per-window cross-spectra.
-    cross = fdata[..., None, :] * fdata[..., None, :, :].conj()
+    # Defines the upper diagonal (and the diagonal within it).
+    triu = np.triu_indices(nnode, k=0)
+    diag = triu[0] == triu[1]
 
-    # Gets the average cross- and auto-spectra.
-    mcross = np.mean(cross, axis=0)
-    mauto = mcross[..., range(nnode), range(nnode), :]
+    # Builds the cross-spectra of the upper diagonal, including the auto-spectra.
+    mcross = np.zeros((nrep, triu[0].size, nfreq), dtype=np.complex128)
+    mcross[:, diag] = spectra["auto"]
+    mcross[:, ~diag] = spectra["cross"]
+    mauto = mcross[:, diag]
 
     # Gets the coherency values.
     num = mcross
-    den = np.sqrt(mauto[:, None, :, :] * mauto[:, :, None, :])
+    den = np.sqrt(mauto[:, triu[0]] * mauto[:, triu[1]])
     coh = num / den
 
-    # Recovers the original shape of the data.
-    coh = coh.reshape(shape[:-2] + (nnode, nnode, -1))
-
-    # Calculates the magnitude-squared coherence and its corrected imaginary counterpart.
     tiny = np.finfo(rawdata.dtype).tiny
-    mscoh = np.abs(coh) ** 2
-    icoh = np.imag(coh)
-    rcoh = np.real(coh)
-    cicoh = abs(icoh / np.sqrt(np.maximum(1 - rcoh * rcoh, tiny)))
+    values = {}
 
-    # Forces the diagonal of corrected imaginary coherence to 0.
-    diag = np.diag_indices(nnode)
-    cicoh[..., diag[0], diag[1], :] = 0
+    # Calculates the magnitude-squared coherence and its (corrected) imaginary counterparts.
+    if "MSC" in measures:
+        values["MSC"] = np.abs(coh) ** 2
 
-    # Averages across frequencies, if requested.
-    if faverage:
-        mscoh = mscoh.mean(axis=-1, keepdims=True)
-        cicoh = cicoh.mean(axis=-1, keepdims=True)
-        freqs = freqs.mean(axis=0, keepdims=True)
-        nfreq = 1
+    if "ciCOH" in measures:
+        icoh = np.imag(coh)
+        rcoh = np.real(coh)
+        values["ciCOH"] = abs(icoh / np.sqrt(np.maximum(1 - rcoh * rcoh, tiny)))
 
-    # Flattens the connectivity matrix.
-    mscoh = mscoh.reshape((nrep, nnode * nnode, nfreq))
-    cicoh = cicoh.reshape((nrep, nnode * nnode, nfreq))
+    if "iCOH" in measures:
+        values["iCOH"] = np.imag(coh)
 
-    # Defines the upper diagonal in the flattened data.
-    triu = np.triu_indices(nnode, k=0)
-    triu = np.ravel_multi_index(triu, (nnode, nnode))
+    # Calculates the (debiased) weighted phase lag index from the per-window imaginary cross-spectra.
+    if "wPLI" in measures:
+        values["wPLI"] = np.zeros((nrep, triu[0].size, nfreq))
+        values["wPLI"][:, ~diag] = np.abs(spectra["cross"].imag) / np.maximum(spectra["absimag"], tiny)
 
-    # Keeps only the upper triangular.
-    mscoh = mscoh[:, triu, 0]
-    cicoh = cicoh[:, triu, 0]
+    if "dwPLI" in measures:
+        sumimag = spectra["cross"].imag * nwin
+        sumabs = spectra["absimag"] * nwin
+        sumsq = spectra["sqimag"] * nwin
+        values["dwPLI"] = np.zeros((nrep, triu[0].size, nfreq))
+        values["dwPLI"][:, ~diag] = (sumimag ** 2 - sumsq) / np.maximum(sumabs ** 2 - sumsq, tiny)
 
-    # # Creates the epoched connectivity objects.
-    # mscoh = mne_connectivity.EpochSpectralConnectivity(
-    #     data=mscoh,
-    #     n_nodes=nnode,
-    #     freqs=freqs,
-    #     indices='symmetric',
-    #     names=nodes,
-    #     method='Magnitude-squared coherence',
-    #     n_epochs_used=nrep)
-    #
-    # cicoh = mne_connectivity.EpochSpectralConnectivity(
-    #     data=cicoh,
-    #     n_nodes=nnode,
-    #     freqs=freqs,
-    #     indices='symmetric',
-    #     names=nodes,
-    #     method='Corrected imaginary part of coherence',
-    #     n_epochs_used=nrep)
+    # Forces the diagonal of the imaginary measures to 0.
+    for measure in ["ciCOH", "iCOH"]:
+        if measure in values:
+            values[measure][:, diag] = 0
 
-    # Averages the epochs connectivity, if requested.
-    if average:
-        mscoh = np.average(mscoh, axis=0)
-        cicoh = np.average(cicoh, axis=0)
+    for measure in values:
+
+        # Averages across the frequencies of each band.
+        if multiband:
+            bindex = [(fmin <= freqs) & (freqs <= fmax) for fmin, fmax in bands]
+            values[measure] = np.stack([values[measure][..., findex].mean(axis=-1) for findex in bindex])
+
+        else:
+            # Averages across frequencies, if requested.
+            if faverage:
+                values[measure] = values[measure].mean(axis=-1, keepdims=True)
+
+            # Keeps only the first frequency.
+            values[measure] = values[measure][:, :, 0]
+
+        # Averages the epochs connectivity, if requested.
+        if average:
+            values[measure] = np.average(values[measure], axis=-2)
+
+    # Creates the connectivity objects, if requested.
+    if container:
+        methods = {"MSC": 'Magnitude-squared coherence', "ciCOH": 'Corrected imaginary part of coherence',
+                   "iCOH": 'Imaginary part of coherency', "wPLI": 'Weighted phase lag index',
+                   "dwPLI": 'Debiased weighted phase lag index'}
+        for measure in values:
+            values[measure] = Connectivity(values[measure], nnode, labels=nodes, method=methods[measure])
 
     # Returns the estimated connectivity.
-    return mscoh, cicoh
+    return values
 
 
 def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0, continuous=False, average=True,
-        single=False):
+        single=None, n_jobs=1, mem_limit=MEMLIMIT, envdecimate=False, container=False):
+    """
+    Amplitude envelope correlation and its leakage-corrected (pairwise orthogonalized) version.
+
+    Envelopes are smoothed with a moving average of smoothing seconds (see moving_average) and, if envdecimate,
+    decimated to the smoothing bandwidth (2.1 times the inverse of the smoothing window) before the correlation.
+
+    The orthogonalization goes through each node in blocks of target nodes sized to mem_limit bytes, and it can
+    be spread over n_jobs threads (numpy kernels release the GIL).
+
+    single=True (or None with mnetools.set_precision(True)) keeps the analytic signal in complex64 from the
+    filtering on; the correlations are accumulated in float64.
+    """
+
+    # Gets the precision of the call.
+    single = mnetools.get_single(single)
+
     # Checks whether the data is a valid MNE object.
     # For now, it only works with sensor-space data.
     if not (isinstance(data, mnetools.mnevalid)):
@@ -732,10 +1537,10 @@ def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0,
             padding = data.time_as_index(0)[0]
 
         # Defines the filter.
-        num = signal.firwin(padding, band, fs=data.info['sfreq'], window='hamming', pass_zero='bandpass')
+        num = bandpass_fir(padding, band, data.info['sfreq'])
 
         # Filters the epoched data using Hilbert filtering.
-        data = mnetools.filtfilt(data, num=num, hilbert=True)
+        data = mnetools.filtfilt(data, num=num, hilbert=True, single=single)
 
         '''
         # Removes the padding.
@@ -757,9 +1562,9 @@ def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0,
     # Extracts the raw data.
     rawdata = data.get_data()
 
-    # Transforms the data into single precision, if requested.
+    # Transforms the data into single precision (complex64 for analytic signals), if requested.
     if single:
-        rawdata = rawdata.astype(np.float32)
+        rawdata = mnetools.as_single(rawdata)
 
     # Defines the minimum possible value.
     tiny = np.finfo(rawdata.dtype).eps
@@ -768,16 +1573,19 @@ def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0,
     spadd = padding
     ssmooth = round(smoothing * data.info['sfreq'])
 
+    # Defines the envelope decimation ratio (2.1 times the smoothing bandwidth).
+    sratio = max(1, math.floor(ssmooth / 2.1)) if envdecimate else 1
+
     # Shortens the padding, if possible.
-    # if spadd > math.ceil(ssmooth / 2):
-    #     # Calculates the extra padding.
-    #     xspadd = spadd - math.ceil(ssmooth / 2)
-    #
-    #     # Removes the extra padding.
-    #     rawdata = rawdata[..., xspadd: -xspadd]
-    #
-    #     # Updates the value of the padding.
-    #     spadd = math.ceil(ssmooth / 2)
+    if spadd > math.ceil(ssmooth / 2):
+        # Calculates the extra padding.
+        xspadd = spadd - math.ceil(ssmooth / 2)
+
+        # Removes the extra padding.
+        rawdata = rawdata[..., xspadd: -xspadd]
+
+        # Updates the value of the padding.
+        spadd = math.ceil(ssmooth / 2)
 
     # Gets the metadata.
     nsamp = rawdata.shape[-1]
@@ -804,11 +1612,8 @@ def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0,
     # Gets the envelope of the signal.
     rawenv = np.abs(rawdata)
 
-    # Smooths the envelope and removes the padding.
-    # rawenv = auxaec.get_mas(rawenv, ssmooth, spadd)
-
-    # Removes the padding.
-    rawenv  = rawenv [..., padding : -padding ]
+    # Smooths the envelope, removes the padding and decimates it.
+    rawenv = moving_average(rawenv, ssmooth, spadd)[..., ::sratio]
 
     # Centers the envelope (as continuous or per repetitions).
     if continuous:
@@ -839,42 +1644,45 @@ def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0,
         proj = rawconc.dot(rawconc.T)
         betas = proj / np.diag(proj)
 
-        # Goes through each signal.
-        for inode in range(nnode):
+        # Sets the number of target nodes per block to fit the temporaries of every thread in memory.
+        block = int(max(1, mem_limit // (4 * n_jobs * nrep * nsamp * rawreal.itemsize)))
 
-            # Removes the projection of the current signal from all the others.
-            regreal = rawreal - betas[:, [inode], None] * rawreal[[inode], :, :]
-            regimag = rawimag - betas[:, [inode], None] * rawimag[[inode], :, :]
-            # regreal = auxaec.get_lc ( rawreal, rawreal [ inode, :, : ], betas [ :, inode ] )
-            # regimag = auxaec.get_lc ( rawimag, rawimag [ inode, :, : ], betas [ :, inode ] )
+        # Orthogonalizes all the signals with respect to one signal.
+        def orthogonalize(inode):
 
-            # Gets the envelope.
-            # regenv = auxaec.get_abs(regreal, regimag)
-            regenv = np.sqrt(regreal ** 2 + regimag ** 2)
+            # Goes through each block of target signals.
+            for j0 in range(0, nnode, block):
+                j1 = min(j0 + block, nnode)
 
-            # Smooths the envelope and removes the padding.
-            # regenv = auxaec.get_mas(regenv, ssmooth, spadd)
+                # Removes the projection of the current signal from the others.
+                regreal = rawreal[j0:j1] - betas[j0:j1, [inode], None] * rawreal[[inode], :, :]
+                regimag = rawimag[j0:j1] - betas[j0:j1, [inode], None] * rawimag[[inode], :, :]
 
-            # Removes the padding.
-            regenv  = regenv [..., spadd : -spadd ]
+                # Gets the envelope.
+                regenv = np.sqrt(regreal ** 2 + regimag ** 2)
 
-            # Centers the envelope (as continuous or per repetitions).
-            if continuous:
-                regenv  = regenv - regenv.mean ( axis = -1, keepdims = True ).mean ( axis = -2, keepdims = True )
-                # regenv = auxaec.demean2(regenv)
-            else:
-                regenv  = regenv - regenv.mean ( axis = -1, keepdims = True )
-                # regenv = auxaec.demean(regenv)
+                # Smooths the envelope, removes the padding and decimates it.
+                regenv = moving_average(regenv, ssmooth, spadd)[..., ::sratio]
+
+                # Centers the envelope (as continuous or per repetitions).
+                if continuous:
+                    regenv = regenv - regenv.mean(axis=-1, keepdims=True).mean(axis=-2, keepdims=True)
+                else:
+                    regenv = regenv - regenv.mean(axis=-1, keepdims=True)
 
-            # Gets the AECov per repetition by matrix multiplication.
-            dummy   = rawenv [ [ inode ], :, : ] * regenv
-            aecovlc [ inode, :, : ] = dummy.sum ( axis = -1 )
-            # aecovlc[inode, :, :] = auxaec.get_dot(regenv, rawenv[inode, :, :])
+                # Gets the AECov per repetition against the (already centered) raw envelope.
+                aecovlc[inode, j0:j1, :] = np.einsum('jrt,rt->jr', regenv, rawenv[inode])
 
-            # Gets the norm per node and repetition.
-            dummy   = regenv * regenv
-            nreg [ inode, :, : ] = dummy.sum ( axis = -1 )
-            # nreg[inode, :, :] = auxaec.get_norm(regenv)
+                # Gets the norm per node and repetition.
+                nreg[inode, j0:j1, :] = np.einsum('jrt,jrt->jr', regenv, regenv)
+
+        # Goes through each signal, optionally in parallel threads.
+        if n_jobs == 1:
+            for inode in range(nnode):
+                orthogonalize(inode)
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                list(executor.map(orthogonalize, range(nnode)))
 
     # If requested, simulates continuous data.
     if continuous:
@@ -947,12 +1755,37 @@ def aec(data, ortho=False, band=None, decimate=False, padding=None, smoothing=0,
         aec = np.average(aec, axis=0)
         aeclc = np.average(aeclc, axis=0)
 
+    # Creates the connectivity objects, if requested.
+    if container:
+        aec = Connectivity(aec, nnode, labels=nodes, method='Temporal AEC')
+        aeclc = Connectivity(aeclc, nnode, labels=nodes, method='Temporal leakage-corrected AEC')
+
     # Returns the estimated connectivity.
     return aec, aeclc
 
 
+def moving_average(data, nsmooth=0, padding=0):
+    """
+    Centered moving average of nsmooth samples along the last axis, obtained from cumulative sums (accumulated
+    in double precision). Removes padding samples at each side; close to the edges the average uses only the
+    available samples.
+    """
 
+    # Gets the samples to keep.
+    nsamp = data.shape[-1]
+    index = np.arange(padding, nsamp - padding)
 
+    # Without smoothing only removes the padding.
+    if nsmooth <= 1:
+        return data[..., index[0]: index[-1] + 1]
 
+    # Gets the cumulative sum with a leading zero.
+    cumsum = np.zeros(data.shape[:-1] + (nsamp + 1,))
+    cumsum[..., 1:] = np.cumsum(data, axis=-1, dtype=np.float64)
 
+    # Gets the limits of the window around each sample.
+    lower = np.clip(index - nsmooth // 2, 0, nsamp)
+    upper = np.clip(index - nsmooth // 2 + nsmooth, 0, nsamp)
 
+    # Gets the average as the difference of the cumulative sums.
+    return ((cumsum[..., upper] - cumsum[..., lower]) / (upper - lower)).astype(data.dtype)
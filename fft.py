@@ -1,6 +1,8 @@
 import time
 import numpy as np
 import scipy.integrate
+import scipy.signal
+import scipy.fft
 import plotly.graph_objects as go
 import plotly.io as pio
 import plotly.offline
@@ -94,6 +96,109 @@ def FFTarray(signals, simLength, transient, regionLabels, param1=None, param2=No
     return np.asarray([param1array, param2array, regLabs, fft_tot, freq_tot, param3array], dtype=object).transpose()
 
 
+def welch_csd(data, samplingFreq, winlen, step, nwin=None, nfft=None, taper="hamming", bands=None, pairs=True,
+              wpli=False, amplitude=False, mem_limit=256 * 1024 ** 2):
+    """
+    Welch cross-spectral density engine shared by fc.coh / fc.spectral_fc (coherence, imaginary coherence, wPLI)
+    and PSD.
+
+    Windows are taken as zero-copy strided views, tapered and Fourier transformed (rfft for real data) in chunks
+    of windows sized to mem_limit bytes, and the spectra are accumulated window by window. Only non-negative
+    frequencies (as in fftfreq) within the requested bands are kept.
+
+    :param data: Signals in shape [... x channels x time]; leading dimensions are flattened as repetitions
+    :param samplingFreq: sampling frequency (Hz)
+    :param winlen: Window length (samples)
+    :param step: Window step (samples)
+    :param nwin: Number of windows (default: all complete windows)
+    :param nfft: Size of the Fourier transform (default: winlen)
+    :param taper: Window function name for scipy.signal.windows.get_window (symmetric)
+    :param bands: list of (fmin, fmax) tuples; frequencies in any of them are kept (default: all)
+    :param pairs: Accumulate the cross-spectra of the upper triangle (k=1)
+    :param wpli: Accumulate |Im| and Im^2 of the cross-spectra (for wPLI and debiased wPLI)
+    :param amplitude: Accumulate the average spectral amplitude |X|
+    Transforms keep the precision of the data (float32/complex64 data stay in single precision), while the
+    window averages are accumulated in float64.
+    :return: dict with freqs, nwin and the window averages: auto [reps x channels x freqs] (power),
+    cross [reps x pairs x freqs], absimag and sqimag [reps x pairs x freqs], amp [reps x channels x freqs]
+    """
+
+    data = np.asarray(data)
+    nchan, nsamp = data.shape[-2], data.shape[-1]
+    data = data.reshape((-1, nchan, nsamp))
+    nrep = data.shape[0]
+
+    if nwin is None:
+        nwin = (nsamp - winlen) // step + 1
+    if nfft is None:
+        nfft = winlen
+    if bands is None:
+        bands = [(0, np.inf)]
+    bands = np.array(bands, ndmin=2)
+
+    # Windows as a strided view: repetitions x channels x windows x samples
+    windata = np.lib.stride_tricks.sliding_window_view(data, winlen, axis=-1)[..., ::step, :][..., :nwin, :]
+    taper = scipy.signal.windows.get_window(taper, winlen, fftbins=False)
+
+    # Keeps the precision of the data (e.g., float32) in the windowed transforms
+    taper = taper.astype(np.result_type(data.real.dtype, np.float32), copy=False)
+
+    # Real Fourier transform for real data (non-negative frequencies only, as in fftfreq)
+    real = np.isrealobj(data)
+    if real:
+        freqs = scipy.fft.rfftfreq(nfft, 1 / samplingFreq)
+        freqs[(nfft + 1) // 2:] = -np.inf
+    else:
+        freqs = scipy.fft.fftfreq(nfft, 1 / samplingFreq)
+
+    findex = np.any((bands[:, :1] <= freqs) & (freqs <= bands[:, 1:]), axis=0)
+    freqs = freqs[findex]
+    nfreq = freqs.size
+
+    triu = np.triu_indices(nchan, k=1)
+    npair = triu[0].size if pairs else 0
+
+    result = dict(freqs=freqs, nwin=nwin, auto=np.zeros((nrep, nchan, nfreq)))
+    if pairs:
+        result["cross"] = np.zeros((nrep, npair, nfreq), dtype=np.complex128)
+    if pairs and wpli:
+        result["absimag"] = np.zeros((nrep, npair, nfreq))
+        result["sqimag"] = np.zeros((nrep, npair, nfreq))
+    if amplitude:
+        result["amp"] = np.zeros((nrep, nchan, nfreq))
+
+    # Windows per chunk to fit the spectra and cross-spectra in memory
+    chunk = int(max(1, mem_limit // (16 * nrep * (nchan * nfft + 2 * npair * nfreq))))
+
+    for w0 in range(0, nwin, chunk):
+        w1 = min(w0 + chunk, nwin)
+
+        # Fourier transform of the tapered windows: repetitions x channels x windows x freqs
+        if real:
+            fdata = scipy.fft.rfft(windata[..., w0:w1, :] * taper, n=nfft, axis=-1, workers=-1)
+        else:
+            fdata = scipy.fft.fft(windata[..., w0:w1, :] * taper, n=nfft, axis=-1, workers=-1)
+        fdata = fdata[..., findex]
+
+        result["auto"] += np.sum(np.abs(fdata) ** 2, axis=-2)
+        if amplitude:
+            result["amp"] += np.sum(np.abs(fdata), axis=-2)
+
+        if pairs:
+            cross = fdata[:, triu[0]] * fdata[:, triu[1]].conj()
+            result["cross"] += np.sum(cross, axis=-2)
+
+            if wpli:
+                result["absimag"] += np.sum(np.abs(cross.imag), axis=-2)
+                result["sqimag"] += np.sum(cross.imag ** 2, axis=-2)
+
+    for key in ["auto", "cross", "absimag", "sqimag", "amp"]:
+        if key in result:
+            result[key] /= nwin
+
+    return result
+
+
 def PSD(signals, samplingFreq, window=4, overlap=0.5):
     """
 
@@ -104,24 +209,19 @@ def PSD(signals, samplingFreq, window=4, overlap=0.5):
     :return:
     """
 
-    fft_result = []
-
     window_size = int(window * samplingFreq)
     step_size = int(window_size * (1 - overlap))
 
-    for roi, roi_signal in enumerate(signals):
-        eSignal = [roi_signal[i: i + window_size] for i in range(0, len(roi_signal) - window_size, step_size)]
-        fft_vector = []
-        for epoch in eSignal:
-            fft_temp = abs(np.fft.fft(epoch))  # FFT for each channel signal
-            fft_temp = fft_temp[range(int(len(epoch) / 2))]  # Select just positive side of the symmetric FFT
-            fft_vector.append(fft_temp)
+    # Average FFT amplitude (no taper) across windows, for all the ROIs at once
+    nwin = len(range(0, np.shape(signals)[-1] - window_size, step_size))
+    spectra = welch_csd(signals, samplingFreq, window_size, step_size, nwin=nwin, taper="boxcar", pairs=False,
+                        amplitude=True)
 
-        fft_result.append(np.average(fft_vector, axis=0))
+    fft_result = spectra["amp"][0][:, :int(window_size / 2)]  # Select just positive side of the symmetric FFT
     freqs = np.arange(window_size / 2)
     freqs = freqs / window
 
-    return np.asarray(fft_result), freqs
+    return fft_result, freqs
 
 
 def PSDplot(signals, samplingFreq, regionLabels, folder="figures", title=None, mode="html", highcut=80, lowcut=1,
@@ -145,20 +245,9 @@ def PSDplot(signals, samplingFreq, regionLabels, folder="figures", title=None, m
 
     fig = go.Figure(layout=dict(title=title, xaxis=dict(title='Frequency', type=type), yaxis=dict(title='Log power (dB)', type=type)))
 
-    window_size = int(window * samplingFreq)
-    step_size = int(window_size * (1 - overlap))
+    fft_result, freqs = PSD(signals, samplingFreq, window=window, overlap=overlap)
 
-    for roi, roi_signal in enumerate(signals):
-        eSignal = [roi_signal[i: i + window_size] for i in range(0, len(roi_signal) - window_size, step_size)]
-        fft_vector = []
-        for epoch in eSignal:
-            fft_temp = abs(np.fft.fft(epoch))  # FFT for each channel signal
-            fft_temp = fft_temp[range(int(len(epoch) / 2))]  # Select just positive side of the symmetric FFT
-            fft_vector.append(fft_temp)
-
-        fft = np.average(fft_vector, axis=0)
-        freqs = np.arange(window_size / 2)
-        freqs = freqs / window
+    for roi, fft in enumerate(fft_result):
 
         cut_high = np.where(freqs >= highcut)[0][0]  # Hz. Number of frequency points until cut at xHz point
         cut_low = np.where(freqs >= lowcut)[0][0]
@@ -22,6 +22,7 @@ import plotly.express as px
 import sys
 sys.path.append("E:\\LCCN_Local\\PycharmProjects\\")
 from pyToolbox.signals import epochingTool
+from pyToolbox import kernels
 
 
 """
@@ -262,7 +263,15 @@ def ngf(data, samplingFreq, picks=None, lowcut=1, highcut=60, resolution=0.25, p
     return result
 
 
-def dfa(data, picks=None, plot=False, folder="figures", title="test"):
+def dfa(data, picks=None, plot=False, folder="figures", title="test", engine="numpy"):
+    """
+    Detrended Fluctuation Analysis (q=2, linear detrending) per channel, with an OLS fit in log-log space.
+
+    :param engine: "numpy" (MFDFA) or "numba" (compiled detrending loop, see kernels.dfa_fluctuations)
+    :return: list of [pick, OLS.coef, OLS.constant, OLS.r2, OLS.pval]
+    """
+
+    engine = kernels.resolve_engine(engine)
 
     if not picks:
         picks = np.arange(0, len(data), 1).tolist()
@@ -280,7 +289,11 @@ def dfa(data, picks=None, plot=False, folder="figures", title="test"):
 
 
         # Obtain the (MF)DFA
-        dfa_lag, dfa_fluct = MFDFA(data[pick, :], lag=lag, q=2, order=1)
+        if engine == "numba":
+            dfa_lag = lag[lag > 2]
+            dfa_fluct = kernels.dfa_fluctuations(np.asarray(data[pick, :], dtype=np.float64), dfa_lag)
+        else:
+            dfa_lag, dfa_fluct = MFDFA(data[pick, :], lag=lag, q=2, order=1)
         ## q determines what moments of the fluctuation function are being considered.
         # q=2 focuses on the second moment of the fluctuation, and it is the value for standard DFA;
         # q>2 focuses on larger fluctuations (more intense behaviour) and viceversa for q<2.
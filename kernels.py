@@ -0,0 +1,207 @@
+
+import warnings
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+"""
+Compiled (numba) kernels for the loop-bound parts of the toolbox: PLV/PLI pair loops (fc.fc), PLE pattern
+counting (fc.ple) and DFA detrending (fluctuations.dfa).
+
+Every kernel visits pairs of channels (or lags) in parallel and accumulates on the fly, so no temporaries of the
+size of the data are allocated. They are selected with engine="numba" in the calling functions, which fall back
+to their numpy implementations when numba is not installed.
+
+Once a parallel kernel has run, numba's threading layer (e.g., TBB or OpenMP) is alive in the process and forking
+it can deadlock the children. Process pools in the toolbox (fc.ple_parallel, surrogates.fc_significance) therefore
+spawn their workers; other fork-based pools should do the same (multiprocessing.get_context("spawn")).
+"""
+
+ENGINES = ["numpy", "numba"]
+
+
+def jit(func):
+    """ Compiles func in parallel mode (nopython), if numba is available."""
+
+    if numba is None:
+        return func
+
+    return numba.njit(parallel=True, cache=True)(func)
+
+
+prange = numba.prange if numba is not None else range
+
+
+def resolve_engine(engine):
+    """ Checks the requested engine and falls back to "numpy" if numba is not available."""
+
+    if engine not in ENGINES:
+        raise ValueError("Unknown engine: %s. Use one of %s." % (engine, ENGINES))
+
+    if engine == "numba" and numba is None:
+        warnings.warn("numba is not installed; falling back to the numpy engine.")
+        return "numpy"
+
+    return engine
+
+
+@jit
+def plv_pairs(sinPhase, cosPhase):
+    """
+    Phase Locking Value of every pair of ROIs, averaged across epochs.
+
+    :param sinPhase: sine of the phases with shape [epochs x rois x time]
+    :param cosPhase: cosine of the phases with shape [epochs x rois x time]
+    :return: PLV matrix (rois, rois)
+    """
+
+    n_epochs, n_rois, n_samples = sinPhase.shape
+    fc_matrix = np.zeros((n_rois, n_rois))
+
+    for roi1 in prange(n_rois):
+        for roi2 in range(roi1, n_rois):
+            value = 0.0
+            for epoch in range(n_epochs):
+                real, imag = 0.0, 0.0
+                for t in range(n_samples):
+                    # exp(1j * (phase1 - phase2))
+                    real += cosPhase[epoch, roi1, t] * cosPhase[epoch, roi2, t] + \
+                        sinPhase[epoch, roi1, t] * sinPhase[epoch, roi2, t]
+                    imag += sinPhase[epoch, roi1, t] * cosPhase[epoch, roi2, t] - \
+                        cosPhase[epoch, roi1, t] * sinPhase[epoch, roi2, t]
+                value += np.sqrt(real * real + imag * imag) / n_samples
+
+            fc_matrix[roi1, roi2] = value / n_epochs
+            fc_matrix[roi2, roi1] = value / n_epochs
+
+    return fc_matrix
+
+
+@jit
+def pli_pairs(sinPhase, cosPhase, measure):
+    """
+    Phase Lag Index family of every pair of ROIs, averaged across epochs.
+
+    :param sinPhase: sine of the phases with shape [epochs x rois x time]
+    :param cosPhase: cosine of the phases with shape [epochs x rois x time]
+    :param measure: 0 for PLI, 1 for wPLI and 2 for dwPLI
+    :return: matrix (rois, rois) with null diagonal
+    """
+
+    n_epochs, n_rois, n_samples = sinPhase.shape
+    tiny = np.finfo(np.float64).tiny
+    fc_matrix = np.zeros((n_rois, n_rois))
+
+    for roi1 in prange(n_rois):
+        for roi2 in range(roi1 + 1, n_rois):
+            value = 0.0
+            for epoch in range(n_epochs):
+                num, den, sqr = 0.0, 0.0, 0.0
+                for t in range(n_samples):
+                    # sin(phase1 - phase2)
+                    sinDifference = sinPhase[epoch, roi1, t] * cosPhase[epoch, roi2, t] - \
+                        cosPhase[epoch, roi1, t] * sinPhase[epoch, roi2, t]
+
+                    if measure == 0:
+                        num += np.sign(sinDifference)
+                    else:
+                        num += sinDifference
+                        den += abs(sinDifference)
+                        sqr += sinDifference * sinDifference
+
+                if measure == 0:
+                    value += abs(num / n_samples)
+                elif measure == 1:
+                    value += abs(num) / max(den, tiny)
+                else:
+                    value += (num * num - sqr) / max(den * den - sqr, tiny)
+
+            fc_matrix[roi1, roi2] = value / n_epochs
+            fc_matrix[roi2, roi1] = value / n_epochs
+
+    return fc_matrix
+
+
+@jit
+def ple_pairs(efPhase, time_lag, pattern_size, subsampling, patts):
+    """
+    Counts the binary patterns of the phase differences of every (ordered) pair of ROIs.
+
+    :param efPhase: Phases with shape [epochs x rois x time]
+    :param time_lag: temporal distance between elements in pattern (timepoints)
+    :param pattern_size: number of elements in each pattern
+    :param subsampling: step between gathered patterns (timepoints)
+    :param patts: Output counts with shape [rois x rois x epochs x 2^pattern_size] (filled in place)
+    """
+
+    n_epochs, n_rois, n_samples = efPhase.shape
+    n_patterns = max(0, (n_samples - time_lag * pattern_size + subsampling - 1) // subsampling)
+
+    for roi1 in prange(n_rois):
+        for roi2 in range(n_rois):
+            for epoch in range(n_epochs):
+                for p in range(n_patterns):
+                    t = p * subsampling
+
+                    # Pattern read as a binary number (first element as the most significant bit)
+                    code = 0
+                    for k in range(pattern_size):
+                        code <<= 1
+                        if efPhase[epoch, roi1, t + k * time_lag] - efPhase[epoch, roi2, t + k * time_lag] > 0:
+                            code |= 1
+
+                    patts[roi1, roi2, epoch, code] += 1
+
+
+@jit
+def dfa_fluctuations(timeseries, lag):
+    """
+    Detrended Fluctuation Analysis (q=2, linear detrending) as in MFDFA(timeseries, lag, q=2, order=1): segments
+    are taken both from the start and from the end of the profile.
+
+    :param timeseries: 1-dimensional signal
+    :param lag: window sizes (ints, > 2)
+    :return: fluctuation function for each lag
+    """
+
+    n_samples = timeseries.size
+    profile = np.cumsum(timeseries - np.mean(timeseries))
+    fluct = np.zeros(lag.size)
+
+    for l in prange(lag.size):
+        size = lag[l]
+        n_segments = n_samples // size
+
+        # Least squares line on x = 1..size: centered abscissa and its sum of squares
+        x_mean = (size + 1) / 2
+        x_ss = size * (size * size - 1) / 12
+
+        total = 0.0
+        for s in range(2 * n_segments):
+            start = s * size if s < n_segments else n_samples % size + (s - n_segments) * size
+
+            y_mean = 0.0
+            for t in range(size):
+                y_mean += profile[start + t]
+            y_mean /= size
+
+            xy = 0.0
+            for t in range(size):
+                xy += (t + 1 - x_mean) * (profile[start + t] - y_mean)
+            slope = xy / x_ss
+
+            # Variance of the residuals around the line
+            var = 0.0
+            for t in range(size):
+                residual = profile[start + t] - y_mean - slope * (t + 1 - x_mean)
+                var += residual * residual
+            total += var / size
+
+        fluct[l] = np.sqrt(total / (2 * n_segments))
+
+    return fluct
@@ -9,6 +9,8 @@ Created on Mon Feb 20 12:40:25 2023
 
 import re
 import datetime
+import hashlib
+from collections import OrderedDict
 
 import mne
 import numpy
@@ -24,10 +26,49 @@ mnevalid = (
 # Sets the verbosity level for MNE.
 mne.set_log_level ( verbose = 'ERROR' )
 
+# Default floating point precision of the filtering and connectivity functions (see set_precision).
+single_precision = False
+
+# Cache of filter spectra, evicted in least-recently-used order (see filter_spectrum).
+spectra = OrderedDict()
+spectra_maxsize = 32
+
+
+# Function to set the default floating point precision.
+def set_precision(single=False):
+    '''
+    Sets the default precision of signal_filtfilt, signal_filterbank, filtfilt and the connectivity functions
+    in fc (fc, dynamic_fc, plv, coh, aec), used whenever they are called with single=None.
+
+    In single precision the data are kept as float32/complex64 from the filtering, through the Hilbert
+    transform, to the connectivity estimation (halving the memory traffic), while the sums across windows and
+    repetitions are accumulated in float64. Connectivity values then stay within 1e-4 (absolute) of the
+    double precision ones. PLI in fc.fc / fc.fc_multi is the exception to the casting: it only counts the sign of
+    sin(phase difference), so a single flip moves it by 2 / (samples x epochs) whatever the precision, and its
+    phases are kept in float64.
+    '''
+
+    global single_precision
+    single_precision = bool(single)
+
+
+# Function to resolve the precision of a call.
+def get_single(single=None):
+    ''' Returns whether to work in single precision: the per-call value or, if None, the default.'''
+
+    return single_precision if single is None else bool(single)
+
+
+# Function to cast the data to single precision.
+def as_single(data):
+    ''' Casts the data to float32 (real data) or complex64 (complex data).'''
+
+    return data.astype(numpy.complex64 if numpy.iscomplexobj(data) else numpy.float32, copy=False)
+
 
 
 # Function for two-pass filtering on MNE objects.
-def filtfilt ( mnedata, num = 1, den = 1, hilbert = False ):
+def filtfilt ( mnedata, num = 1, den = 1, hilbert = False, single = None ):
     """ Wrapper to apply two-pass filtering to MNE objects."""
     
     
@@ -64,6 +105,10 @@ def filtfilt ( mnedata, num = 1, den = 1, hilbert = False ):
         # Restores the original data shape.
         rawdata  = rawdata.reshape ( dshape )
 
+        # Transforms the data into single precision, if requested.
+        if get_single ( single ):
+            rawdata  = as_single ( rawdata )
+
     # For FIR filters use FFT (much faster, same accuracy).
     else:
 
@@ -72,7 +117,8 @@ def filtfilt ( mnedata, num = 1, den = 1, hilbert = False ):
             rawdata,
             num = num,
             den = den,
-            hilbert = hilbert )
+            hilbert = hilbert,
+            single = single )
     
     # Replaces the data and marks it as loaded.
     mnedata._data = rawdata
@@ -154,7 +200,7 @@ def decimate (
 
 
 # Function for two-pass filtering.
-def signal_filtfilt(data, num=1, den=1, hilbert=False):
+def signal_filtfilt(data, num=1, den=1, hilbert=False, single=None):
     ''' Filters the provided data in two passes.'''
 
     # Sanitizes the inputs.
@@ -164,6 +210,10 @@ def signal_filtfilt(data, num=1, den=1, hilbert=False):
 
     if data.ndim == 0:
         data = data.reshape(-1)
+
+    # Transforms the data into single precision, if requested.
+    if get_single(single):
+        data = as_single(data)
     if num.ndim == 0:
         num = num.reshape(-1)
     if den.ndim == 0:
@@ -182,8 +232,93 @@ def signal_filtfilt(data, num=1, den=1, hilbert=False):
     dorder = den[:-1, ].size
     order = norder + dorder
 
+    # Estimates the optimal chunk and FFT sizes.
+    # IIR responses are not finite, so they use the longest chunks (as few boundaries as possible).
+    if dorder:
+        nfft = min(50000, nsample) + 2 * order
+    else:
+        nfft = optnfft(nsample, order)
+
+    # Uses the real Fourier transform for real data (the filter spectrum is real and symmetric).
+    rfft = not hilbert and not numpy.iscomplexobj(data)
+
+    # Gets the (cached) two-pass spectrum of the filter, in the precision of the data.
+    Ffilter = filter_spectrum(num, den, nfft, hilbert=hilbert, rfft=rfft,
+                              dtype=numpy.result_type(data.dtype, numpy.complex64))
+
+    # Uses a complex output, if required.
+    output = data
+    if hilbert:
+        output = numpy.empty(data.shape, dtype=numpy.result_type(data.dtype, numpy.complex64))
+
+    # Filters the data (in place, if possible).
+    _overlap_save(data, [Ffilter], order, nfft, rfft, real and not hilbert, output[None])
+    data = output
+
+    # Restores the data shape.
+    data = data.reshape(dshape)
+
+    # Returns the filtered data.
+    return data
+
+
+# Function for two-pass filtering with a bank of FIR filters.
+def signal_filterbank(data, nums, hilbert=False, single=None):
+    ''' Filters the provided data in two passes with several FIR filters sharing the forward FFT.'''
+
+    # Sanitizes the inputs.
+    data = numpy.array(data)
+    nums = [numpy.array(num).reshape(-1) for num in nums]
+    nband = len(nums)
+
+    if data.ndim == 0:
+        data = data.reshape(-1)
+
+    # Transforms the data into single precision, if requested.
+    if get_single(single):
+        data = as_single(data)
+
+    # Gets the data metadata.
+    dshape = data.shape
+    nsample = dshape[-1]
+    real = numpy.isreal(data).all()
+
+    # Reshapes the data into a 2D array.
+    data = data.reshape((-1, nsample))
+
+    # Uses the longest filter to define the padding.
+    order = max(num.size for num in nums) - 1
+
     # Estimates the optimal chunk and FFT sizes.
     nfft = optnfft(nsample, order)
+
+    # Uses the real Fourier transform for real data (the filters spectra are real and symmetric).
+    rfft = not hilbert and not numpy.iscomplexobj(data)
+
+    # Gets the (cached) two-pass spectrum of each filter, in the precision of the data.
+    Fbank = [filter_spectrum(num, 1, nfft, hilbert=hilbert, rfft=rfft,
+                             dtype=numpy.result_type(data.dtype, numpy.complex64)) for num in nums]
+
+    # Initializes the output as bands x data.
+    dtype = data.dtype if (real and not hilbert) else numpy.result_type(data.dtype, numpy.complex64)
+    bankdata = numpy.zeros((nband,) + data.shape, dtype=dtype)
+
+    # Filters the data with each filter.
+    _overlap_save(data, Fbank, order, nfft, rfft, real and not hilbert, bankdata)
+
+    # Restores the data shape.
+    bankdata = bankdata.reshape((nband,) + dshape)
+
+    # Returns the filtered data.
+    return bankdata
+
+
+# Function for overlap-save filtering with a bank of two-pass spectra.
+def _overlap_save(data, Fbank, order, nfft, rfft, real, out):
+    ''' Filters each row of the 2D data with each spectrum in Fbank, storing the results in out (bands x data).'''
+
+    # Gets the chunk size.
+    nsample = data.shape[-1]
     chsize = nfft - 2 * order
 
     # Calculates the butterfly reflections of the data.
@@ -193,6 +328,68 @@ def signal_filtfilt(data, num=1, den=1, hilbert=False):
     # Adds the reflections as padding.
     paddata = numpy.concatenate((prepad, data, pospad), axis=-1)
 
+    # Goes through each data chunk.
+    for index in range(0, numpy.ceil(nsample / chsize).astype(int)):
+
+        # Calculates the offset and length for the current chunk.
+        offset = index * chsize
+        chlen = numpy.min((chsize, nsample - offset))
+
+        # Gets the chunk plus the padding.
+        chunk = paddata[:, offset: offset + chlen + 2 * order]
+
+        # Takes the Fourier transform of the chunk only once.
+        if rfft:
+            Fchunk = fft.rfft(chunk, n=nfft, axis=-1, norm=None, workers=-1)
+        else:
+            Fchunk = fft.fft(chunk, n=nfft, axis=-1, norm=None, workers=-1)
+
+        # Goes through each filter.
+        for band, Ffilter in enumerate(Fbank):
+
+            # Applies the filter and recovers the filtered chunk.
+            if rfft:
+                Ochunk = fft.irfft(Fchunk * Ffilter, n=nfft, axis=-1, workers=-1)
+            else:
+                Ochunk = fft.ifft(Fchunk * Ffilter, n=nfft, axis=-1, workers=-1)
+
+            # Gets only the real part, if required.
+            if real:
+                Ochunk = Ochunk.real
+
+            # Stores the filtered chunk of data.
+            out[band, :, offset: offset + chlen] = Ochunk[:, order: order + chlen]
+
+    # Returns the filtered data.
+    return out
+
+
+# Function to get the two-pass spectrum of a filter.
+def filter_spectrum(num, den=1, nfft=None, hilbert=False, rfft=False, dtype=numpy.complex128):
+    '''
+    Returns the squared magnitude of the frequency response of the filter num / den (two passes) with nfft
+    points, with the Hilbert mask applied (if hilbert) and only the non-negative frequencies (if rfft).
+
+    Spectra are memoized by (coefficients hash, nfft, hilbert, rfft, dtype), keeping the spectra_maxsize most
+    recently used ones, so repeated calls with the same design skip the filter FFTs. The returned array is
+    read-only.
+    '''
+
+    # Sanitizes the inputs.
+    num = numpy.array(num)
+    den = numpy.array(den)
+
+    if num.ndim == 0:
+        num = num.reshape(-1)
+    if den.ndim == 0:
+        den = den.reshape(-1)
+
+    # Looks for the spectrum in the cache.
+    key = (fingerprint(num), fingerprint(den), int(nfft), bool(hilbert), bool(rfft), numpy.dtype(dtype).str)
+    if key in spectra:
+        spectra.move_to_end(key)
+        return spectra[key]
+
     # Gets the Fourier transform of the filter.
     Fnum = fft.fft(num, n=nfft, axis=-1, norm=None)
     Fden = fft.fft(den, n=nfft, axis=-1, norm=None)
@@ -208,6 +405,7 @@ def signal_filtfilt(data, num=1, den=1, hilbert=False):
 
     # Gets the squared absolute value of the filter (two-passes).
     Ffilter = Ffilter * Ffilter.conjugate()
+    Ffilter = Ffilter.astype(dtype)
 
     # Applies Hilbert transform, if required.
     if hilbert:
@@ -216,60 +414,70 @@ def signal_filtfilt(data, num=1, den=1, hilbert=False):
         sneg = (fft.fftfreq(nfft) < 0) & (fft.fftfreq(nfft) > -0.5)
 
         # Removes the negative part of the filter spectrum.
-        Ffilter[sneg,] = 0
+        Ffilter[..., sneg] = 0
 
         # Duplicates the positive part of the filter spectrum.
-        Ffilter[spos,] = Ffilter[spos,] * 2
+        Ffilter[..., spos] = Ffilter[..., spos] * 2
 
-        # Converts the input data into complex.
-        data = data + 0j
+    # Keeps only the non-negative frequencies, if required.
+    if rfft:
+        Ffilter = Ffilter[..., :nfft // 2 + 1].copy()
 
-    # Goes through each data chunk.
-    for index in range(0, numpy.ceil(nsample / chsize).astype(int)):
+    # Stores the spectrum (read-only) and evicts the least recently used ones.
+    Ffilter.setflags(write=False)
+    if spectra_maxsize > 0:
+        spectra[key] = Ffilter
+        while len(spectra) > spectra_maxsize:
+            spectra.popitem(last=False)
 
-        # Calculates the offset and length for the current chunk.
-        offset = index * chsize
-        chlen = numpy.min((chsize, nsample - offset))
+    # Returns the spectrum.
+    return Ffilter
 
-        # Gets the chunk plus the padding.
-        chunk = paddata[:, offset: offset + chlen + 2 * order].copy()
 
-        # Takes the Fourier transform of the chunk.
-        Fchunk = fft.fft(chunk, n=nfft, axis=-1, norm=None, workers=-1)
+# Function to resize (or disable) the cache of filter spectra.
+def set_spectra_cache(maxsize=32):
+    ''' Sets the number of filter spectra kept in cache (0 disables the cache).'''
 
-        # Applies the filter.
-        Fchunk = Fchunk * Ffilter
+    global spectra_maxsize
+    spectra_maxsize = int(maxsize)
 
-        # Recovers the filtered chunk.
-        chunk = fft.ifft(Fchunk, n=nfft, axis=-1, workers=-1)
+    while len(spectra) > max(spectra_maxsize, 0):
+        spectra.popitem(last=False)
 
-        # Gets only the real part, if required.
-        if real and not hilbert:
-            chunk = chunk.real
 
-        # Stores the filtered chunk of data.
-        data[:, offset: offset + chlen] = chunk[:, order: order + chlen]
+# Function to get the hash of an array (used as cache key).
+def fingerprint(data):
+    ''' Hash of the content, shape and dtype of an array.'''
 
-    # Restores the data shape.
-    data = data.reshape(dshape)
+    data = numpy.ascontiguousarray(data)
+    digest = hashlib.blake2b(data.view(numpy.uint8).reshape(-1), digest_size=16)
+    digest.update(str((data.shape, data.dtype.str)).encode())
 
-    # Returns the filtered data.
-    return data
+    return digest.hexdigest()
 
 
 # Function to get the optimal chunk size for the FFT.
-def optnfft(nsample, order=0):
-    '''Returns the optimal length of the FFT.'''
+def optnfft(nsample, order=0, maxchunk=50000):
+    '''
+    Returns the optimal length of the FFT for overlap-save filtering.
+
+    Each FFT of nfft samples yields nfft - 2 * order filtered samples, so the candidate lengths (fast sizes
+    from scipy.fft.next_fast_len) are compared by the total cost of filtering nsample samples, i.e., number of
+    chunks x nfft x log2(nfft). Chunks are limited to maxchunk samples to bound the memory.
+    '''
 
-    # Uses the closest multiple of 512 * 5 samples larger than 10 filters.
-    nfft = 512 * 5 * numpy.ceil((10 * order) / (512 * 5))
-    nfft = nfft.astype(int)
+    # Sanitizes the inputs.
+    nsample = int(nsample)
+    order = int(order)
 
-    # If lower than 51200, uses 51200.
-    nfft = numpy.max((nfft, 51200))
+    # Lists the candidate lengths, from the shortest useful one to a single (maximum) chunk.
+    nmin = 2 * order + 1
+    nmax = fft.next_fast_len(max(1, min(maxchunk, nsample)) + 2 * order)
+    sizes = {fft.next_fast_len(int(size)) for size in numpy.geomspace(nmin, nmax, 64)}
+    sizes = [size for size in sizes if size <= nmax] + [nmax]
 
-    # For checking with Matlab.
-    nfft = numpy.min((50000, nsample)) + 2 * order
+    # Gets the cost of filtering all the samples with each length.
+    cost = [numpy.ceil(nsample / (size - 2 * order)) * size * numpy.log2(max(size, 2)) for size in sizes]
 
-    # Returns the optimal chunck size.
-    return nfft
\ No newline at end of file
+    # Returns the optimal FFT length.
+    return sizes[int(numpy.argmin(cost))]
\ No newline at end of file
@@ -0,0 +1,137 @@
+
+import time
+import multiprocessing
+
+import numpy as np
+from scipy import fft
+from concurrent.futures import ProcessPoolExecutor
+
+import sys
+sys.path.append("E:\\LCCN_Local\\PycharmProjects\\")
+from pyToolbox import fc as fctools
+
+
+def surrogates(signals, n_surrogates, method="phase", seed=None, n_iter=10, fsignals=None):
+    """
+    Batch of surrogate signals generated in the frequency domain (vectorized over surrogates and ROIs).
+
+    - "phase": phase randomized; keeps the amplitude spectrum of each ROI with independent random phases,
+    thus destroying the coupling between ROIs.
+    - "shift": each ROI is circularly shifted by an independent random lag.
+    - "iaaft": Iterative Amplitude Adjusted Fourier Transform; keeps both the amplitude spectrum and the
+    amplitude distribution of each ROI (Schreiber & Schmitz, 1996).
+
+    :param signals: Signals in shape [ROIS x time]
+    :param n_surrogates: Number of surrogates in the batch
+    :param method: "phase", "shift" or "iaaft"
+    :param seed: Seed or np.random.Generator
+    :param n_iter: Iterations for IAAFT
+    :param fsignals: Precomputed real Fourier transform of the signals (to reuse it across batches)
+    :return: surrogates with shape [n_surrogates x ROIS x time]
+    """
+
+    rng = np.random.default_rng(seed)
+    signals = np.asarray(signals)
+    n_rois, n_samples = signals.shape
+
+    if method == "shift":
+        shifts = rng.integers(0, n_samples, (n_surrogates, n_rois, 1))
+        return np.take_along_axis(signals[np.newaxis], (np.arange(n_samples) + shifts) % n_samples, axis=-1)
+
+    if method not in ["phase", "iaaft"]:
+        raise ValueError("Unknown surrogate method: %s" % method)
+
+    if fsignals is None:
+        fsignals = fft.rfft(signals, axis=-1)
+    amplitude = np.abs(fsignals)
+
+    # Random phases; DC (and Nyquist) keep their original (real) value
+    phases = rng.uniform(0, 2 * np.pi, (n_surrogates,) + fsignals.shape)
+    phases[..., 0] = np.angle(fsignals[..., 0])
+    if n_samples % 2 == 0:
+        phases[..., -1] = np.angle(fsignals[..., -1])
+
+    surr = fft.irfft(amplitude * np.exp(1j * phases), n=n_samples, axis=-1, workers=-1)
+
+    if method == "iaaft":
+        sorted_signals = np.sort(signals, axis=-1)
+
+        for i in range(n_iter):
+            # Imposes the amplitude distribution by rank ordering
+            ranks = np.argsort(np.argsort(surr, axis=-1), axis=-1)
+            surr = np.take_along_axis(np.broadcast_to(sorted_signals, surr.shape), ranks, axis=-1)
+
+            # Imposes the amplitude spectrum
+            fsurr = fft.rfft(surr, axis=-1, workers=-1)
+            surr = fft.irfft(amplitude * np.exp(1j * np.angle(fsurr)), n=n_samples, axis=-1, workers=-1)
+
+        # Ends with the exact amplitude distribution
+        ranks = np.argsort(np.argsort(surr, axis=-1), axis=-1)
+        surr = np.take_along_axis(np.broadcast_to(sorted_signals, surr.shape), ranks, axis=-1)
+
+    return surr
+
+
+def fc_significance(signals, samplingFreq, measure="PLV", n_surrogates=1000, method="phase", batch=50, n_jobs=None,
+                    seed=None, verbose=True, **kwargs):
+    """
+    Surrogate-based significance of the FC between every pair of ROIs.
+
+    Surrogates are generated in batches reusing the Fourier transform of the original signals and each batch
+    is processed in a pool of n_jobs processes (n_jobs=1 runs in the current process).
+
+    :param signals: Signals in shape [ROIS x time]
+    :param samplingFreq: sampling frequency (Hz)
+    :param measure: any fc.fc measure ("PLV", "PLI", "wPLI", "dwPLI", "AEC", "CORR")
+    :param n_surrogates: Size of the null distribution
+    :param method: Surrogate method (see surrogates())
+    :param batch: Surrogates generated per task
+    :param kwargs: Other fc.fc parameters (e.g., lowcut, highcut)
+    :return: fc_matrix (observed), null [n_surrogates x edges] and pvalues [edges] for the upper triangle (k=1)
+    """
+
+    tic = time.time()
+    signals = np.asarray(signals, dtype=np.float64)
+    triu = np.triu_indices(len(signals), 1)
+
+    fc_matrix = fctools.fc(signals, samplingFreq, measure=measure, **kwargs)
+
+    # Independent seeds per batch
+    sizes = [min(batch, n_surrogates - b0) for b0 in range(0, n_surrogates, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(size, seed_, method, measure, samplingFreq, kwargs) for size, seed_ in zip(sizes, seeds)]
+
+    if verbose:
+        print("Calculating %i %s surrogates for %s" % (n_surrogates, method, measure), end="")
+
+    if n_jobs == 1:
+        _surrogates_init(signals)
+        null = [_surrogates_batch(*task) for task in tasks]
+    else:
+        # Spawned (not forked) workers, as forking after numba kernels have run (kernels) can deadlock
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_surrogates_init, initargs=(signals,),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            null = list(executor.map(_surrogates_batch, *zip(*tasks)))
+
+    null = np.concatenate(null)
+
+    # One-sided p-value per edge: proportion of surrogates at least as large as the observed FC
+    pvalues = (1 + np.sum(null >= fc_matrix[triu], axis=0)) / (n_surrogates + 1)
+
+    if verbose:
+        print("  -  %0.3f seconds.\n" % (time.time() - tic,))
+
+    return fc_matrix, null, pvalues
+
+
+def _surrogates_init(signals):
+    global _signals, _fsignals
+    _signals = signals
+    _fsignals = fft.rfft(signals, axis=-1)
+
+
+def _surrogates_batch(size, seed, method, measure, samplingFreq, kwargs):
+    triu = np.triu_indices(len(_signals), 1)
+    surr = surrogates(_signals, size, method=method, seed=seed, fsignals=_fsignals)
+
+    return np.array([fctools.fc(s, samplingFreq, measure=measure, **kwargs)[triu] for s in surr])
@@ -0,0 +1,15 @@
+
+import os
+import sys
+import importlib.util
+
+# The toolbox is imported as the "pyToolbox" package (see the sys.path entries in its modules): registers this
+# checkout under that name so the tests run from any clone directory.
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if "pyToolbox" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("pyToolbox", os.path.join(root, "__init__.py"),
+                                                  submodule_search_locations=[root])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["pyToolbox"] = module
+    spec.loader.exec_module(module)
@@ -0,0 +1,68 @@
+
+import numpy as np
+import pytest
+
+pytest.importorskip("numba")
+
+from pyToolbox import fc, kernels
+
+
+@pytest.fixture
+def phases():
+    rng = np.random.default_rng(0)
+    return rng.uniform(-np.pi, np.pi, (3, 12, 1500))
+
+
+def test_plv(phases):
+    np.testing.assert_allclose(fc.fc_plv(phases, engine="numba"), fc.fc_plv(phases, engine="numpy"), atol=1e-12)
+
+
+@pytest.mark.parametrize("measure", ["PLI", "wPLI", "dwPLI"])
+def test_pli(phases, measure):
+    np.testing.assert_allclose(fc.fc_pli(phases, measure=measure, engine="numba"),
+                               fc.fc_pli(phases, measure=measure, engine="numpy"), atol=1e-12)
+
+
+@pytest.mark.parametrize("subsampling", [1, 3])
+def test_ple(phases, subsampling):
+    PLE_numba, patts_numba = fc.ple(phases, 4, 3, 1000, subsampling=subsampling, engine="numba")
+    PLE_numpy, patts_numpy = fc.ple(phases, 4, 3, 1000, subsampling=subsampling, engine="numpy")
+
+    np.testing.assert_array_equal(patts_numba, patts_numpy)
+    np.testing.assert_allclose(PLE_numba, PLE_numpy, atol=1e-12)
+
+
+def dfa_reference(timeseries, lag):
+    """ DFA (q=2, linear detrending) with np.polyfit, segmenting the profile from the start and from the end."""
+
+    n_samples = timeseries.size
+    profile = np.cumsum(timeseries - np.mean(timeseries))
+
+    fluct = []
+    for size in lag:
+        n_segments = n_samples // size
+        segments = np.concatenate([profile[:n_segments * size].reshape(n_segments, size),
+                                   profile[n_samples % size:].reshape(n_segments, size)])
+
+        x = np.arange(1, size + 1)
+        coefs = np.polyfit(x, segments.T, 1)
+        residuals = segments - (coefs[0][:, np.newaxis] * x + coefs[1][:, np.newaxis])
+        fluct.append(np.sqrt(np.mean(np.var(residuals, axis=1))))
+
+    return np.array(fluct)
+
+
+def test_dfa_fluctuations():
+    rng = np.random.default_rng(0)
+    timeseries = np.cumsum(rng.normal(size=5000)) * 0.01 + rng.normal(size=5000)
+    lag = np.unique(2 * np.logspace(0.5, 3, 50).astype(int))
+    lag = lag[lag > 2]
+
+    np.testing.assert_allclose(kernels.dfa_fluctuations(timeseries, lag), dfa_reference(timeseries, lag),
+                               rtol=1e-10)
+
+
+def test_resolve_engine():
+    assert kernels.resolve_engine("numba") == "numba"
+    with pytest.raises(ValueError):
+        kernels.resolve_engine("cuda")